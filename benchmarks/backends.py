@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Check that both HTML parsing backends produce the same output.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: backends.py [SCALE]
+
+Convert the documents of the benchmark suite (the synthetic documents, scaled
+by the given factor which defaults to 0.2, and the bundled documents in the
+fixtures directory) as well as a document full of parser edge cases (script,
+style and textarea elements, character references, implicitly closed
+elements) using html2vimdoc, once with the streaming parser and once with
+BeautifulSoup. Reports the documents whose output differs (and the first line
+that differs) and exits with status 1 when there are any.
+"""
+
+# Standard library modules.
+import logging
+import os
+import sys
+
+# Make it possible to import html2vimdoc and the benchmark suite.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+import suite
+
+# Document with the constructs that the backends are most likely to handle
+# differently.
+EDGE_CASES = '''
+<html>
+  <head>
+    <title>Parser edge cases</title>
+    <script>var x = "a &amp; b &lt;c&gt;";</script>
+    <style>p:after { content: "&gt;" }</style>
+  </head>
+  <body>
+    <div id="content">
+      <h1>Parser edge cases</h1>
+      <p>Character references: &amp; &lt; &gt; &copy; &#169; &#xA9; &unknown; &apos;</p>
+      <script>if (a &lt; b &amp;&amp; c) { x("<b>bold</b>"); }</script>
+      <style>p:after { content: "&gt;" } <b>not bold</b></style>
+      <textarea>Text &amp; <i>markup</i>
+        in a text area</textarea>
+      <noscript>No &amp; script</noscript>
+      <p>Paragraph <p>closed implicitly</p>
+      <ul><li>Item <li>Item with <code>code &lt;here&gt;</code></ul>
+      <pre>
+  Preformatted   text &amp; <b>markup</b>
+      </pre>
+      <!-- A comment &amp; more -->
+      <table><tr><td>Cell <td>Cell &amp; more</table>
+    </div>
+  </body>
+</html>
+'''
+
+def main():
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    documents = suite.load_corpus(scale)
+    documents.append(('edge-cases.html', EDGE_CASES, False))
+    different = 0
+    for name, text, is_markdown in documents:
+        if is_markdown:
+            text = html2vimdoc.markdown_to_html(text, suite.MARKDOWN_EXTENSIONS)
+        outputs = [html2vimdoc.html2vimdoc(text, filename=os.path.splitext(name)[0] + '.txt', parser=parser)
+                   for parser in ('htmlparser', 'beautifulsoup')]
+        if outputs[0] == outputs[1]:
+            print "%s: same output" % name
+        else:
+            different += 1
+            lines = [output.splitlines() for output in outputs]
+            for i, (streaming, soup) in enumerate(map(None, *lines), start=1):
+                if streaming != soup:
+                    break
+            print "%s: different output! (line %i)" % (name, i)
+            print "  htmlparser:    %r" % streaming
+            print "  beautifulsoup: %r" % soup
+    print "%i of %i document(s) differ." % (different, len(documents))
+    if different:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# Measure the memory used by simplified parse trees.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: compact_tree.py [SECTIONS]
+
+Generate a synthetic HTML document with the given number of sections (the
+default is 2000, about 72,000 nodes) and convert it using html2vimdoc with the
+regular object tree and with a CompactTree, using both parsers. Every
+measurement runs in a new Python process which reports its peak resident set
+size (RSS) after parsing the document and after the complete conversion,
+minus the peak RSS before parsing (the interpreter, the modules and the
+generated document). Reports the peak RSS of each mode (and per node of the
+simplified parse tree) and how much less the compact tree uses.
+"""
+
+# Standard library modules.
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+PARSERS = ('htmlparser', 'beautifulsoup')
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3], sys.argv[4] == 'compact', int(sys.argv[5]))
+        return
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for parser in PARSERS:
+        results = {}
+        for tree in ('object', 'compact'):
+            results[tree] = dict((stage, run_measurement(stage, parser, tree, sections))
+                                 for stage in ('parse', 'convert'))
+            parsed = results[tree]['parse']
+            print "%s, %s tree: %s after parsing (%i bytes per node), %s after conversion" % (
+                parser, tree, format_size(parsed['peak_rss']),
+                parsed['peak_rss'] / parsed['nodes'],
+                format_size(results[tree]['convert']['peak_rss']))
+        ratios = [results['object'][stage]['peak_rss'] / float(results['compact'][stage]['peak_rss'])
+                  for stage in ('parse', 'convert')]
+        print "%s, reduction: %.1fx after parsing, %.1fx after conversion" % (parser, ratios[0], ratios[1])
+
+def run_measurement(stage, parser, tree, sections):
+    """
+    Run a measurement in a new Python process, returns a dictionary with the
+    peak RSS in bytes (and the number of nodes after parsing).
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--measure', stage, parser, tree, str(sections)]
+    return json.loads(subprocess.check_output(command))
+
+def measure(stage, parser, compact_tree, sections):
+    """
+    Parse or convert the synthetic document and print the increase of the
+    peak RSS of the process (as a JSON object).
+    """
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    html = generate_document(sections)
+    baseline = peak_rss()
+    if stage == 'parse':
+        parse = html2vimdoc.parse_with_beautifulsoup if parser == 'beautifulsoup' else html2vimdoc.parse_with_htmlparser
+        title, root = parse(html, '', '#content', [], compact_tree=compact_tree)
+        result = dict(peak_rss=peak_rss() - baseline)
+        index = html2vimdoc.NodeIndex.create(root)
+        index.update()
+        result['nodes'] = len(index.nodes)
+    else:
+        stats = html2vimdoc.ConversionStats()
+        html2vimdoc.html2vimdoc(html, filename='manual.txt', stream=NullStream(),
+                                parser=parser, compact_tree=compact_tree, stats=stats)
+        result = dict(peak_rss=stats.counters['peak_memory'] - baseline)
+    print json.dumps(result)
+
+def peak_rss():
+    """
+    Get the peak RSS of the process in bytes (the same way as
+    ``ConversionStats.measure_memory()``).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def format_size(value):
+    """
+    Format a number of bytes as megabytes.
+    """
+    return "%.1f MB" % (value / 1024.0 / 1024.0)
+
+class NullStream(object):
+
+    """
+    Stream that discards the output of the conversion.
+    """
+
+    def write(self, text):
+        pass
+
+def generate_document(sections):
+    """
+    Generate an HTML document that looks like a typical (indented) manual.
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n']
+    for i in xrange(sections):
+        html.append('      <h2>Section %i: <code>function_%i()</code></h2>\n' % (i, i))
+        html.append('      <p>\n        The <code>function_%i()</code> function is described\n'
+                    '        <a href="http://example.com/%i">here</a>, <em>see also</em> the\n'
+                    '        <strong>other</strong> functions.\n      </p>\n' % (i, i))
+        html.append('      <ul>\n        <li>First item</li>\n        <li>Second item\n'
+                    '          <ul>\n            <li>Nested <tt>item</tt></li>\n          </ul>\n'
+                    '        </li>\n      </ul>\n')
+        html.append('      <pre>\nexample(%i)\n      </pre>\n' % i)
+    html.append('    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+if __name__ == '__main__':
+    main()
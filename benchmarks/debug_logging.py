@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Measure the cost of debug logging and tracing.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: debug_logging.py [SECTIONS] [REPEAT]
+
+Generate a synthetic HTML document with the given number of sections (the
+default is 500), each with a heading, a paragraph with links and code
+fragments and a list, and convert it using html2vimdoc with debug logging
+disabled, with debug logging enabled and with debug logging and tracing
+enabled (see the --verbose and --trace options). Log messages are written to
+/dev/null. Each conversion is repeated the given number of times (the default
+is 3) and the best time is reported.
+"""
+
+# Standard library modules.
+import logging
+import os
+import sys
+import time
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+def main():
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    html = generate_document(sections)
+    print "Document size: %i KB (%i sections)" % (len(html) / 1024, sections)
+    # Send the log messages to /dev/null instead of the terminal.
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setLevel(logging.DEBUG)
+    original_handlers = html2vimdoc.logger.handlers[:]
+    html2vimdoc.logger.handlers[:] = [handler]
+    outputs = []
+    try:
+        for label, debug, trace in (("Debug logging disabled", False, False),
+                                    ("Debug logging enabled", True, False),
+                                    ("Debug logging and tracing enabled", True, True)):
+            html2vimdoc.logger.setLevel(logging.DEBUG if debug else logging.INFO)
+            html2vimdoc.tracer.setLevel(logging.DEBUG if trace else logging.INFO)
+            timings = []
+            for i in xrange(repeat):
+                start_time = time.time()
+                output = html2vimdoc.html2vimdoc(html, filename='benchmark.txt')
+                timings.append(time.time() - start_time)
+            outputs.append(output)
+            print "%s: %.2f seconds" % (label, min(timings))
+    finally:
+        html2vimdoc.logger.handlers[:] = original_handlers
+        html2vimdoc.logger.setLevel(logging.INFO)
+        html2vimdoc.tracer.setLevel(logging.INFO)
+    identical = all(o == outputs[0] for o in outputs)
+    print "Output identical: %s" % ("yes" if identical else "NO")
+    if not identical:
+        sys.exit(1)
+
+def generate_document(sections):
+    """
+    Generate an HTML document with a variety of block level and inline
+    elements, to exercise most of the debug messages.
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n']
+    for i in xrange(sections):
+        html.append('      <h2>The <code>function_%i()</code> function</h2>\n' % i)
+        html.append('      <p>\n        Works like <code>function_%i()</code>, ' % ((i + 1) % sections))
+        html.append('see <a href="http://example.com/%i">the <em>manual</em></a> ' % i)
+        html.append('and <strong>the <a href="http://example.com/faq">FAQ</a></strong> for details.\n      </p>\n')
+        html.append('      <ul>\n')
+        for j in xrange(3):
+            html.append('        <li>Item %i of section %i with <code>option_%i</code></li>\n' % (j, i, j))
+        html.append('      </ul>\n')
+    html.append('    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Measure the time spent joining and wrapping inline text.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: inline_layout.py [DEPTH] [PARAGRAPHS]
+
+Generate synthetic HTML documents with the given number of paragraphs (the
+default is 200) that contain inline markup nested to the given depth (the
+default is 50), convert them using html2vimdoc and report the time spent in
+join_inline(). The first document contains plain words, the second also
+contains hyphenated and long words (in nested text that's longer than a line
+these are still wrapped at every level of nesting to keep the output the
+same). The documents are converted a second time with the previous
+implementation of join_inline() (which wrapped the text at every level of
+nesting) to check that the output is the same. Finally a few small documents
+that each exercise one of the cases where the nested text is still wrapped
+are checked the same way.
+"""
+
+# Standard library modules.
+import logging
+import os
+import sys
+import textwrap
+import time
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+# Nested text that exercises the branches of InlineText.end_nested().
+FILLER = ' '.join(['filler'] * 12)
+WRAPPING_CASES = (
+    ("Hyphens in long nested text",
+     '<p>Some <em>%s well-known facts and more words</em> here.</p>' % ('x' * 70)),
+    ("Long words in long nested text",
+     '<p>Some <em>%s %s and more</em> here.</p>' % ('x' * 90, FILLER)),
+    ("Long last word in long nested text",
+     '<p>Some <em>%s %s</em> here.</p>' % (FILLER, 'x' * 90)),
+)
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    paragraphs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    identical = True
+    for label, hyphenated in (("Plain words", False), ("Hyphenated and long words", True)):
+        html = generate_document(depth, paragraphs, hyphenated)
+        print "%s: %i KB (nesting depth %i)" % (label, len(html) / 1024, depth)
+        layout_time, layout_output = convert(html, html2vimdoc.join_inline)
+        print "  Single line breaking pass: %.2f seconds in join_inline()" % layout_time
+        wrapping_time, wrapping_output = convert(html, nested_join_inline)
+        print "  Wrapping at every level: %.2f seconds in join_inline()" % wrapping_time
+        print "  Output identical: %s" % ("yes" if layout_output == wrapping_output else "NO")
+        identical = identical and layout_output == wrapping_output
+    for label, html in WRAPPING_CASES:
+        html = '<div id="content">%s</div>' % html
+        same = convert(html, html2vimdoc.join_inline)[1] == convert(html, nested_join_inline)[1]
+        print "%s: %s" % (label, "ok" if same else "DIFFERENT")
+        identical = identical and same
+    if not identical:
+        sys.exit(1)
+
+def convert(html, join_inline):
+    """
+    Convert the document using the given implementation of join_inline() and
+    return the time spent in the outermost calls to join_inline() and the
+    output.
+    """
+    timings = []
+    def timed_join_inline(nodes, **kw):
+        if timings and timings[-1] is None:
+            # Nested call (the time is included in the outermost call).
+            return join_inline(nodes, **kw)
+        timings.append(None)
+        start_time = time.time()
+        try:
+            return join_inline(nodes, **kw)
+        finally:
+            timings[-1] = time.time() - start_time
+    original = html2vimdoc.join_inline
+    html2vimdoc.join_inline = timed_join_inline
+    try:
+        output = html2vimdoc.html2vimdoc(html, filename='benchmark.txt')
+    finally:
+        html2vimdoc.join_inline = original
+    return sum(timings), output
+
+def nested_join_inline(nodes, **kw):
+    """
+    The previous implementation of join_inline(): Nested inline nodes render
+    (and wrap) their own text, which is compacted and wrapped again.
+    """
+    prefix = ' ' * kw['indent']
+    kw['indent'] = 0
+    rendered_nodes = [n.render(**kw) for n in nodes]
+    return "\n".join(textwrap.wrap(html2vimdoc.compact("".join(rendered_nodes)),
+                                   initial_indent=prefix,
+                                   subsequent_indent=prefix,
+                                   width=html2vimdoc.TEXT_WIDTH - len(prefix)))
+
+def generate_document(depth, paragraphs, hyphenated):
+    """
+    Generate an HTML document with paragraphs of text in deeply nested inline
+    markup (optionally including hyphenated words and long words).
+    """
+    words = ['inline', 'markup', 'is', 'nested', 'deeply', 'evidently', 'text']
+    if hyphenated:
+        words[-3:-1] = ['well-known', 'self-evident']
+    # Only <span> elements can be nested in themselves (the parser closes an
+    # open <em>, <strong> or <a> element when another one starts).
+    tags = ['em', 'strong', 'a href="http://example.com/"'] + ['span'] * (depth - 3)
+    html = ['<html>\n  <body>\n    <div id="content">\n']
+    for i in xrange(paragraphs):
+        html.append('      <p>\n')
+        for level in xrange(depth):
+            html.append('<%s>%s ' % (tags[level], ' '.join(words[(i + level + j) % len(words)] for j in xrange(5))))
+            if hyphenated and level % 10 == 9:
+                html.append('%s ' % ('x' * 90))
+        for level in xrange(depth - 1, -1, -1):
+            html.append(' text</%s>' % tags[level].split()[0])
+        html.append('\n      </p>\n')
+    html.append('    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+if __name__ == '__main__':
+    main()
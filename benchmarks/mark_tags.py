@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Measure the time spent marking references to tags.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: mark_tags.py [SECTIONS]
+
+Generate a synthetic HTML document with the given number of sections (the
+default is 1000), each with a tagged heading and a paragraph full of code
+fragments, and convert it using html2vimdoc. Reports the time spent in
+the MarkTags pass and checks that the output is the same as with a second
+MarkTags pass after generating the table of contents (which html2vimdoc
+used to run).
+"""
+
+# Standard library modules.
+import logging
+import os
+import sys
+import time
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+def main():
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    html = generate_document(sections)
+    print "Code fragments in document: %i" % html.count('<code>')
+    # Wrap the MarkTags pass to measure how long it takes.
+    MarkTags = html2vimdoc.MarkTags
+    timings = []
+    arguments = []
+    class TimedMarkTags(MarkTags):
+        def __init__(self, index, tags, vim_tags=None):
+            MarkTags.__init__(self, index, tags, vim_tags)
+            timings.append(0.0)
+            arguments[:] = [index, tags]
+        def visit(self, node):
+            start_time = time.time()
+            MarkTags.visit(self, node)
+            timings[-1] += time.time() - start_time
+        def finish(self):
+            start_time = time.time()
+            MarkTags.finish(self)
+            timings[-1] += time.time() - start_time
+    html2vimdoc.MarkTags = TimedMarkTags
+    start_time = time.time()
+    single_pass = html2vimdoc.html2vimdoc(html, filename='benchmark.txt')
+    print "Conversion: %.2f seconds" % (time.time() - start_time)
+    print "Marking references: %.3f seconds (%i pass)" % (sum(timings), len(timings))
+    # Convert the document again with the second pass after generating the
+    # table of contents.
+    TableOfContents = html2vimdoc.TableOfContents
+    class TwoPasses(TableOfContents):
+        def finish(self):
+            TableOfContents.finish(self)
+            index, tags = arguments
+            html2vimdoc.run_passes(index, [TimedMarkTags(index, tags)])
+    html2vimdoc.TableOfContents = TwoPasses
+    del timings[:]
+    two_pass = html2vimdoc.html2vimdoc(html, filename='benchmark.txt')
+    print "Marking references: %.3f seconds (%i passes, second pass %.3f seconds)" % (sum(timings), len(timings), timings[-1])
+    print "Output of single pass identical to two passes: %s" % ("yes" if single_pass == two_pass else "NO")
+    if single_pass != two_pass:
+        sys.exit(1)
+
+def generate_document(sections):
+    """
+    Generate an HTML document that documents a lot of functions which refer
+    to each other (and to some functions that aren't documented).
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n']
+    for i in xrange(sections):
+        html.append('      <h2>The <code>function_%i()</code> function</h2>\n' % i)
+        html.append('      <p>\n        Works like ')
+        html.append(', '.join('<code>function_%i()</code>' % ((i * 7 + j * 13) % (sections * 2)) for j in xrange(8)))
+        html.append('\n        (see also <code>function_%i()</code>).\n      </p>\n' % ((i + 1) % sections))
+    html.append('    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+if __name__ == '__main__':
+    main()
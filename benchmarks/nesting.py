@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Stress test html2vimdoc with deeply nested documents.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: nesting.py [DEPTH]
+
+Generate synthetic HTML documents with elements nested to the given depth (the
+default is 5000) and convert them using html2vimdoc (with the streaming parser,
+with BeautifulSoup and with a compact tree). There are three documents: One with
+nested <div> elements (block level nesting, like the pages generated by some
+documentation frameworks), one with nested <span> elements (inline nesting)
+and one with nested <table> elements (tables in table cells, like old
+layout-by-table pages, nested to a tenth of the given depth). Also checks
+that nested block level sequences keep their own delimiters (rendering them
+without recursion used to drop the empty line between a list bullet and a
+paragraph nested in a <div>). Reports the time spent on each conversion and exits with status 1
+when a conversion fails (for example because the recursion limit was hit).
+"""
+
+# Standard library modules.
+import logging
+import os
+import sys
+import time
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+MODES = [
+    ('htmlparser', dict()),
+    ('beautifulsoup', dict(parser='beautifulsoup')),
+    ('compact', dict(compact_tree=True)),
+]
+
+# A list item whose paragraph is nested in a <div> and the expected rendering
+# of the list (the same as before nested sequences were rendered without
+# recursion).
+NESTED_SEQUENCES = '<div id="content"><ul><li><div><p>foo bar</p></div></li><li>baz</li></ul></div>'
+NESTED_SEQUENCES_OUTPUT = '\n- \n\n  foo bar\n\n- baz\n'
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    failed = False
+    for kind, generate, levels in (('div', generate_blocks, depth),
+                                   ('span', generate_inline, depth),
+                                   ('table', generate_tables, depth / 10)):
+        html = generate(levels)
+        for mode, options in MODES:
+            start_time = time.time()
+            try:
+                html2vimdoc.html2vimdoc(html, filename='nesting.txt', **options)
+                status = "%.2f seconds" % (time.time() - start_time)
+            except RuntimeError, e:
+                status = "failed! (%s)" % e
+                failed = True
+            print "Nested <%s> elements, depth %i, %s: %s" % (kind, levels, mode, status)
+    for mode, options in MODES:
+        output = html2vimdoc.html2vimdoc(NESTED_SEQUENCES, filename='nesting.txt', **options)
+        if NESTED_SEQUENCES_OUTPUT in output:
+            status = "ok"
+        else:
+            status = "failed! (expected %r)" % NESTED_SEQUENCES_OUTPUT
+            failed = True
+        print "Delimiters of nested sequences, %s: %s" % (mode, status)
+    if failed:
+        sys.exit(1)
+
+def generate_blocks(depth):
+    """
+    Generate an HTML document with nested <div> elements (every 500 levels
+    there's a heading and a paragraph).
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n      <h1>Nesting</h1>\n']
+    for i in xrange(depth):
+        html.append('<div class="level-%i">' % i)
+        if i % 500 == 0:
+            html.append('<h2>Level %i</h2><p>Text at level <code>%i</code> with a <a href="http://example.com/%i">link</a>.</p>' % (i, i, i))
+    html.append('<p>The innermost paragraph.</p>')
+    html.append('</div>' * depth)
+    html.append('\n    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+def generate_inline(depth):
+    """
+    Generate an HTML document with a paragraph containing nested <span>
+    elements (each one containing a word).
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n      <h1>Nesting</h1>\n      <p>Outer text ']
+    for i in xrange(depth):
+        html.append('<span>word%i ' % i)
+    html.append('<code>innermost()</code>')
+    html.append('</span>' * depth)
+    html.append(' more text.</p>\n    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+def generate_tables(depth):
+    """
+    Generate an HTML document with nested <table> elements (each one with a
+    row containing a cell with a word and a cell with the next table).
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n      <h1>Nesting</h1>\n']
+    for i in xrange(depth):
+        html.append('<table><tr><td>cell%i</td><td>' % i)
+    html.append('<p>The innermost cell.</p>')
+    html.append('</td></tr></table>' * depth)
+    html.append('\n    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+if __name__ == '__main__':
+    main()
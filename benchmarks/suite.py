@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+# Benchmark suite for html2vimdoc.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: suite.py [OPTIONS]
+
+Convert a corpus of synthetic and bundled documents using html2vimdoc and
+report the time spent in each conversion (end to end and in each stage, see
+ConversionStats) as well as the time spent in markdown_to_html() for the
+Markdown documents, both with the reused Markdown converter and with a new
+converter for every document. Everything runs offline.
+
+The synthetic documents are generated with a controlled number of headings,
+nesting depth of lists, number of code fragments and number of links (see
+SYNTHETIC_DOCUMENTS). The bundled documents are the manuals in the fixtures
+directory: an HTML reference manual laid out like the Lua reference manual and
+the README of a Vim plug-in written in Markdown.
+
+Valid options:
+
+  -o, --output=FILE     write the results to FILE (as JSON), for example
+                        to store a baseline for later comparisons
+  -b, --baseline=FILE   compare the results to the (JSON) results in FILE
+                        and exit with status 1 when a benchmark regressed
+  -t, --threshold=PCT   percentage by which a timing can exceed the baseline
+                        before it's considered a regression (default 10)
+  -m, --metric=NAME     timing that's compared to the baseline, either
+                        'wall_time' (the default) or 'cpu_time'
+  -r, --repeat=N        convert each document N times and keep the best
+                        timings (default 3)
+  -s, --scale=FACTOR    multiply the size of the synthetic documents by
+                        FACTOR (the depth of lists is not scaled)
+  -f, --filter=STR      only run the benchmarks whose name contains STR
+  -j, --jobs=N          number of worker processes of the parallel rendering
+                        benchmarks (the default is the number of CPUs, 0
+                        disables these benchmarks)
+  -h, --help            show this message and exit
+
+The parallel rendering benchmarks (html2vimdoc_parallel/NAME) convert each
+document again with the sections rendered in worker processes (see the
+--parallel option of html2vimdoc) so that their timings can be compared to
+the serial conversions (html2vimdoc/NAME). On a single CPU html2vimdoc
+renders serially anyway.
+
+Markdown benchmarks are skipped when the Markdown module isn't installed.
+"""
+
+# Standard library modules.
+import collections
+import contextlib
+import getopt
+import imp
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+# Directory with the bundled documents.
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Parameters of the synthetic documents (each one is generated as HTML and as
+# Markdown). The sizes are multiplied by the --scale option.
+SYNTHETIC_DOCUMENTS = [
+    ('small', dict(headings=20, list_depth=2, code_fragments=100, links=50)),
+    ('headings', dict(headings=1000, list_depth=1, code_fragments=1000, links=200)),
+    ('deep-lists', dict(headings=50, list_depth=12, code_fragments=200, links=100)),
+    ('code', dict(headings=200, list_depth=2, code_fragments=5000, links=100)),
+    ('links', dict(headings=200, list_depth=2, code_fragments=200, links=3000)),
+]
+
+# Timings shorter than this (in seconds) are too noisy to compare.
+MIN_TIME = 0.005
+
+# Markdown extensions used to convert the Markdown documents.
+MARKDOWN_EXTENSIONS = ['fenced_code']
+
+def main():
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'o:b:t:m:r:s:f:j:h', ['output=',
+            'baseline=', 'threshold=', 'metric=', 'repeat=', 'scale=', 'filter=', 'jobs=', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__.strip()
+        sys.exit(1)
+    output = None
+    baseline = None
+    threshold = 10.0
+    metric = 'wall_time'
+    repeat = 3
+    scale = 1.0
+    pattern = ''
+    jobs = multiprocessing.cpu_count()
+    for option, value in options:
+        if option in ('-o', '--output'):
+            output = value
+        elif option in ('-b', '--baseline'):
+            baseline = value
+        elif option in ('-t', '--threshold'):
+            threshold = float(value)
+        elif option in ('-m', '--metric'):
+            if value not in ('wall_time', 'cpu_time'):
+                print "Unsupported metric %r! (expected 'wall_time' or 'cpu_time')" % value
+                sys.exit(1)
+            metric = value
+        elif option in ('-r', '--repeat'):
+            repeat = int(value)
+        elif option in ('-s', '--scale'):
+            scale = float(value)
+        elif option in ('-f', '--filter'):
+            pattern = value
+        elif option in ('-j', '--jobs'):
+            jobs = int(value)
+        elif option in ('-h', '--help'):
+            print __doc__.strip()
+            sys.exit(0)
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    results = run_suite(load_corpus(scale), repeat, pattern, jobs)
+    results['scale'] = scale
+    if output:
+        with open(output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+            handle.write("\n")
+        print "Wrote results to %s." % output
+    if baseline:
+        with open(baseline) as handle:
+            previous = json.load(handle, object_pairs_hook=collections.OrderedDict)
+        regressions = compare_results(previous, results, metric, threshold)
+        if regressions:
+            print "%i timing(s) regressed by more than %.1f%%!" % (len(regressions), threshold)
+            sys.exit(1)
+        print "No timings regressed by more than %.1f%%." % threshold
+
+def load_corpus(scale=1.0):
+    """
+    Get the documents to benchmark as a list of (name, text, is_markdown)
+    tuples: the synthetic documents (scaled by the given factor) followed by
+    the bundled documents.
+    """
+    corpus = []
+    for name, parameters in SYNTHETIC_DOCUMENTS:
+        parameters = dict(parameters)
+        for key in ('headings', 'code_fragments', 'links'):
+            parameters[key] = max(1, int(parameters[key] * scale))
+        corpus.append(('synthetic-%s.html' % name, generate_html(**parameters), False))
+        corpus.append(('synthetic-%s.md' % name, generate_markdown(**parameters), True))
+    for filename in sorted(os.listdir(FIXTURES_DIRECTORY)):
+        with open(os.path.join(FIXTURES_DIRECTORY, filename)) as handle:
+            corpus.append((filename, handle.read(), filename.endswith('.md')))
+    return corpus
+
+def run_suite(corpus, repeat=3, pattern='', jobs=0):
+    """
+    Run the benchmarks on the given corpus (see ``load_corpus()``). When
+    ``jobs`` is given the documents are also converted with the sections
+    rendered in that many worker processes. Returns the results as a
+    dictionary that can be serialized as JSON.
+    """
+    try:
+        imp.find_module('markdown')
+        have_markdown = True
+    except ImportError:
+        have_markdown = False
+    benchmarks = collections.OrderedDict()
+    for name, text, is_markdown in corpus:
+        if is_markdown and not have_markdown:
+            print "Skipping %s (the Markdown module isn't installed)." % name
+            continue
+        key = 'markdown_to_html/%s' % name
+        if is_markdown and pattern in key:
+            benchmarks[key] = benchmark_markdown(text, repeat)
+            report(key, benchmarks[key])
+        key = 'markdown_to_html_fresh/%s' % name
+        if is_markdown and pattern in key:
+            benchmarks[key] = benchmark_markdown(text, repeat, fresh=True)
+            report(key, benchmarks[key])
+        key = 'html2vimdoc/%s' % name
+        if pattern in key:
+            benchmarks[key] = benchmark_conversion(name, text, is_markdown, repeat)
+            report(key, benchmarks[key])
+        key = 'html2vimdoc_parallel/%s' % name
+        if jobs and pattern in key:
+            benchmarks[key] = benchmark_conversion(name, text, is_markdown, repeat,
+                                                   render_workers=jobs, parallel_threshold=0)
+            report(key, benchmarks[key])
+    return collections.OrderedDict([('python', platform.python_version()),
+                                    ('repeat', repeat),
+                                    ('benchmarks', benchmarks)])
+
+def benchmark_conversion(name, text, is_markdown, repeat, **options):
+    """
+    Convert a document using ``html2vimdoc()`` the given number of times (any
+    keyword arguments are passed on to ``html2vimdoc()``). Returns the best
+    end to end timings, the best timings of each stage and the counters of
+    the conversion.
+    """
+    timings = []
+    stages = collections.OrderedDict()
+    counters = None
+    for i in xrange(repeat):
+        stats = html2vimdoc.ConversionStats()
+        with measure() as timing:
+            html2vimdoc.html2vimdoc(text, filename=os.path.splitext(name)[0] + '.txt',
+                                    markdown_extensions=MARKDOWN_EXTENSIONS if is_markdown else None,
+                                    stats=stats, **options)
+        timings.append(timing)
+        results = stats.to_dict()
+        for stage, stage_timing in results['stages'].iteritems():
+            stages[stage] = best_timing(stages.get(stage), stage_timing)
+        counters = results['counters']
+    result = best_timing(None, *timings)
+    result['input_size'] = len(text)
+    result['stages'] = stages
+    result['counters'] = counters
+    return result
+
+def benchmark_markdown(text, repeat, fresh=False):
+    """
+    Convert a Markdown document to HTML using ``markdown_to_html()`` the given
+    number of times. When ``fresh`` is True the Markdown converters are
+    forgotten before each conversion, so every conversion creates a new
+    converter (like html2vimdoc used to do for every document) instead of
+    reusing the one created by the previous conversion. Returns the best
+    timings.
+    """
+    timings = []
+    for i in xrange(repeat):
+        if fresh:
+            html2vimdoc.markdown_converters.clear()
+        with measure() as timing:
+            html2vimdoc.markdown_to_html(text, MARKDOWN_EXTENSIONS)
+        timings.append(timing)
+    result = best_timing(None, *timings)
+    result['input_size'] = len(text)
+    return result
+
+@contextlib.contextmanager
+def measure():
+    """
+    Context manager that measures the wall clock time and CPU time of a block
+    of code (in a dictionary that's filled in when the block has finished).
+    """
+    timing = collections.OrderedDict()
+    wall_time = time.time()
+    cpu_time = html2vimdoc.get_cpu_time()
+    yield timing
+    timing['wall_time'] = time.time() - wall_time
+    timing['cpu_time'] = html2vimdoc.get_cpu_time() - cpu_time
+
+def best_timing(best, *timings):
+    """
+    Get the shortest wall clock time and CPU time of the given timings.
+    """
+    result = collections.OrderedDict(best or ())
+    for timing in timings:
+        for key in ('wall_time', 'cpu_time'):
+            result[key] = min(result.get(key, timing[key]), timing[key])
+    return result
+
+def report(name, result):
+    """
+    Print the timings of a benchmark.
+    """
+    print "%-45s %8.3fs wall %8.3fs cpu" % (name, result['wall_time'], result['cpu_time'])
+    for stage, timing in result.get('stages', {}).iteritems():
+        print "  %-43s %8.3fs wall %8.3fs cpu" % (stage, timing['wall_time'], timing['cpu_time'])
+    workers = result.get('counters', {}).get('render_workers')
+    if workers:
+        print "  (rendered using %i worker process(es))" % workers
+
+def compare_results(baseline, results, metric='wall_time', threshold=10.0):
+    """
+    Compare the end to end and per stage timings of the benchmarks that occur
+    in both results. Timings shorter than ``MIN_TIME`` are ignored. Prints the
+    timings that regressed by more than ``threshold`` percent and returns a
+    list of their names.
+    """
+    if baseline.get('scale', 1.0) != results.get('scale', 1.0):
+        print "Warning: The baseline was recorded with scale %s, the results with scale %s!" \
+            % (baseline.get('scale', 1.0), results.get('scale', 1.0))
+    regressions = []
+    for name, result in results['benchmarks'].iteritems():
+        previous = baseline['benchmarks'].get(name)
+        if not previous:
+            continue
+        pairs = [(name, previous, result)]
+        for stage, timing in result.get('stages', {}).iteritems():
+            if stage in previous.get('stages', {}):
+                pairs.append(('%s:%s' % (name, stage), previous['stages'][stage], timing))
+        for label, old, new in pairs:
+            if max(old[metric], new[metric]) < MIN_TIME:
+                continue
+            change = (new[metric] - old[metric]) / max(old[metric], MIN_TIME) * 100
+            if change > threshold:
+                print "Regression: %s took %.3fs (baseline %.3fs, %+.1f%%)" % (label, new[metric], old[metric], change)
+                regressions.append(label)
+            elif change < -threshold:
+                print "Improvement: %s took %.3fs (baseline %.3fs, %+.1f%%)" % (label, new[metric], old[metric], change)
+    return regressions
+
+def generate_html(headings, list_depth, code_fragments, links):
+    """
+    Generate an HTML document with the given number of headings (sections),
+    lists nested to the given depth (one list per section) and the given
+    number of code fragments and links (spread evenly over the sections).
+    Every other heading contains a code fragment that's referenced from the
+    text of other sections, so the document also has references to tags.
+    """
+    html = ['<html>\n  <head>\n    <title>Synthetic document</title>\n  </head>\n',
+            '  <body>\n    <div id="content">\n      <h1>Synthetic document</h1>\n']
+    for i in xrange(headings):
+        level = 2 if i % 3 == 0 else 3
+        if i % 2 == 0:
+            html.append('      <h%i>The <code>function_%i()</code> function</h%i>\n' % (level, i, level))
+        else:
+            html.append('      <h%i>Section %i about things</h%i>\n' % (level, i, level))
+        html.append('      <p>\n        This section describes things.')
+        for j in xrange(spread(code_fragments, headings, i)):
+            html.append(' It works like <code>function_%i()</code>.' % ((i * 7 + j * 2) % (headings + 10)))
+        for j in xrange(spread(links, headings, i)):
+            html.append(' See <a href="http://example.com/%i/%i">the <em>manual</em></a>.' % (i % 50, j))
+        html.append('\n      </p>\n')
+        html.append(generate_html_list(list_depth, '      '))
+        html.append('      <p>For example:</p>\n')
+        html.append('      <pre>\nexample_%i(arguments)\n      </pre>\n' % i)
+    html.append('    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+def generate_html_list(depth, indent):
+    """
+    Generate an HTML list nested to the given depth.
+    """
+    if depth <= 0:
+        return ''
+    return ''.join([
+        '%s<ul>\n' % indent,
+        '%s  <li>An item with <strong>strong text</strong></li>\n' % indent,
+        '%s  <li>An item with a nested list\n' % indent,
+        generate_html_list(depth - 1, indent + '    '),
+        '%s  </li>\n' % indent,
+        '%s</ul>\n' % indent,
+    ])
+
+def generate_markdown(headings, list_depth, code_fragments, links):
+    """
+    Generate a Markdown document with the same structure as the HTML document
+    generated by ``generate_html()``.
+    """
+    markdown = ['# Synthetic document\n\n']
+    for i in xrange(headings):
+        marker = '##' if i % 3 == 0 else '###'
+        if i % 2 == 0:
+            markdown.append('%s The `function_%i()` function\n\n' % (marker, i))
+        else:
+            markdown.append('%s Section %i about things\n\n' % (marker, i))
+        markdown.append('This section describes things.')
+        for j in xrange(spread(code_fragments, headings, i)):
+            markdown.append(' It works like `function_%i()`.' % ((i * 7 + j * 2) % (headings + 10)))
+        for j in xrange(spread(links, headings, i)):
+            markdown.append(' See [the *manual*](http://example.com/%i/%i).' % (i % 50, j))
+        markdown.append('\n\n')
+        for level in xrange(list_depth):
+            indent = '    ' * level
+            markdown.append('%s- An item with **strong text**\n' % indent)
+            markdown.append('%s- An item with a nested list\n' % indent)
+        markdown.append('\nFor example:\n\n    example_%i(arguments)\n\n' % i)
+    return ''.join(markdown)
+
+def spread(total, parts, i):
+    """
+    Get the share of part ``i`` when ``total`` is spread evenly over the
+    given number of parts.
+    """
+    return total // parts + (1 if i < total % parts else 0)
+
+if __name__ == '__main__':
+    main()
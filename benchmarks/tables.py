@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# Measure the time spent rendering tables.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: tables.py [COLUMNS] [ROWS]
+
+Generate synthetic HTML documents with a table of the given number of columns
+(the default is 4) and an increasing number of rows (up to the given number,
+the default is 8000), convert them using html2vimdoc and report the time spent
+rendering each table and the time per row, which should stay the same as the
+number of rows grows. The tables are rendered once with short cells (as
+aligned columns) and once with long cells (which don't fit in the text width,
+so the rows are rendered as a list).
+"""
+
+# Standard library modules.
+import logging
+import os
+import sys
+import time
+
+# Make it possible to import html2vimdoc from the parent directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import html2vimdoc
+
+def main():
+    columns = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    max_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    # Wrap Table.render() to measure how long it takes.
+    render = html2vimdoc.Table.render
+    timings = []
+    def timed_render(self, **kw):
+        start_time = time.time()
+        output = render(self, **kw)
+        timings.append(time.time() - start_time)
+        return output
+    html2vimdoc.Table.render = timed_render
+    for label, cell_text in (("Columns", "cell"), ("List", "a cell with a lot of text in it")):
+        rows = max_rows / 8
+        while rows <= max_rows:
+            del timings[:]
+            html2vimdoc.html2vimdoc(generate_document(columns, rows, cell_text), filename='benchmark.txt')
+            print "%s layout, %i columns, %i rows: %.3f seconds (%.1f microseconds per row)" \
+                % (label, columns, rows, sum(timings), sum(timings) / rows * 1000000)
+            rows *= 2
+
+def generate_document(columns, rows, cell_text):
+    """
+    Generate an HTML document with a table of the given size.
+    """
+    html = ['<html>\n  <body>\n    <div id="content">\n      <h2>Table</h2>\n      <table>\n']
+    html.append('        <tr>%s</tr>\n' % ''.join('<th>Column %i</th>' % i for i in xrange(columns)))
+    for i in xrange(rows):
+        html.append('        <tr>%s</tr>\n' % ''.join('<td>%s <code>%i</code></td>' % (cell_text, i * j)
+                                                   for j in xrange(columns)))
+    html.append('      </table>\n    </div>\n  </body>\n</html>\n')
+    return ''.join(html)
+
+if __name__ == '__main__':
+    main()
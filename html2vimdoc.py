@@ -7,21 +7,26 @@
 # Last Change: May 21, 2015
 # URL: http://peterodding.com/code/vim/tools/
 #
-# Missing features:
-# TODO Support for <table> elements.
-#
 # Finding the right abstractions:
 # FIXME Quirky mix of classes and functions?
 # FIXME The OutputDelimiter stuff is a bit crazy, but I kind of need it? Complexity :-(
 
 """
 html2vimdoc [OPTIONS] [LOCATION]
+html2vimdoc [OPTIONS] --batch INPUT OUTPUT [INPUT OUTPUT ...]
+html2vimdoc [OPTIONS] --manifest=FILE
 
 Convert HTML (and Markdown) documents to Vim help files. When LOCATION is given
 it is assumed to be the filename or URL of the input, if --url is given that
 URL will be used, otherwise the script reads from standard input. The generated
 Vim help file is written to standard output.
 
+In batch mode many documents are converted in a pool of worker processes. The
+inputs and outputs are given as pairs of positional arguments or in a manifest
+file that contains one INPUT OUTPUT pair per line (empty lines and lines
+starting with '#' are ignored). The base name of each output file is used as
+the name of the generated help file.
+
 Valid options:
 
   -f, --file=NAME  name of generated help file (embedded
@@ -31,8 +36,45 @@ Valid options:
   -x, --ext=NAME   enable the named Markdown extension (only
                    relevant when input is Markdown; the extension
                    'fenced_code' is enabled by default)
+  -r, --runtime-tags  turn code fragments that match tags in Vim's
+                   documentation (like 'tabstop' or feedkeys()) into
+                   tag references (uses $VIMRUNTIME/doc/tags)
+  -R, --vim-tags=FILE  like --runtime-tags but use the given tags file
+  -c, --compact    store the parse tree in compact arrays while parsing
+                   (uses less memory when converting very large
+                   documents, unless BeautifulSoup is used)
+  -n, --no-cache   don't use the conversion cache (by default converted
+                   documents are cached in ~/.cache/html2vimdoc)
+  -i, --incremental  cache the rendered sections of documents and only
+                   render the sections that changed since the previous
+                   conversion (ignored when --no-cache is given)
+  -g, --tags=FILE  write a Vim help tags file with the tags defined
+                   by the generated help file(s), so that you don't
+                   need to run Vim's :helptags command
+  -G, --update-tags=FILE  like --tags but keep the existing entries
+                   of other help files in FILE
+  -B, --beautifulsoup  parse HTML using BeautifulSoup instead of
+                   the (faster) streaming parser
+  -b, --batch      convert the INPUT OUTPUT pairs given as arguments
+  -m, --manifest=FILE  convert the INPUT OUTPUT pairs listed in FILE
+  -j, --jobs=N     number of worker processes in batch mode
+                   (defaults to the number of CPUs)
+  -P, --parallel=N  render the sections of large documents in N worker
+                   processes (at most one per CPU; ignored in batch mode
+                   and with --incremental)
+      --parallel-threshold=NODES  minimum size of the documents that are
+                   rendered in parallel (in parse tree nodes, the default
+                   is 50000)
   -p, --preview    preview generated Vim help file in Vim
+  -s, --stats=json  report the time spent in each stage of the conversion
+                   and some counters (as a JSON object per document written
+                   to standard error; use --no-cache to measure every stage).
+                   The streaming parser selects the title, drops comments
+                   and simplifies the tree while parsing, so these stages
+                   are part of 'parse' (they're reported separately with
+                   --beautifulsoup)
   -v, --verbose    make more noise (a lot of noise)
+  -T, --trace      also log messages about individual nodes (even more noise)
   -h, --help       show this message and exit
 
 This program tries to produce reasonable output given only an HTML or Markdown
@@ -54,14 +96,29 @@ The easiest way to install them is in a Python virtual environment:
 """
 
 # Standard library modules.
+import array
+import bisect
+import codecs
 import collections
+import contextlib
 import getopt
+import glob
+import hashlib
+import HTMLParser
+import htmlentitydefs
+import io
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import re
+import resource
 import sys
+import tempfile
 import textwrap
-import types
+import time
 import urllib
 import urlparse
 
@@ -81,11 +138,53 @@ import libs.soupselect as soupselect
 TEXT_WIDTH = 79
 SHIFT_WIDTH = 2
 
+# Location and size limit (in bytes) of the conversion cache.
+CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'html2vimdoc')
+CACHE_SIZE = 1024 * 1024 * 20
+
+# Location of the cache of rendered sections (see --incremental).
+SECTION_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, 'sections')
+
+# Minimum size (in parse tree nodes) of documents whose sections are rendered
+# in parallel (see --parallel).
+PARALLEL_THRESHOLD = 50000
+
+# Minimum number of sections per worker process when rendering in parallel.
+PARALLEL_MIN_SECTIONS = 2
+
 # Initialize the logging subsystem.
 logger = logging.getLogger('html2vimdoc')
 logger.setLevel(logging.INFO)
 logger.addHandler(coloredlogs.ColoredStreamHandler(show_name=True))
 
+# Messages about individual nodes (how HTML elements are mapped to nodes, how
+# inline nodes are rendered, etc.) are logged to a separate channel which is
+# disabled unless requested using --trace, because there are so many of them.
+tracer = logging.getLogger('html2vimdoc.trace')
+tracer.setLevel(logging.INFO)
+
+class DebugSwitch(object):
+
+    """
+    Remembers whether a logger accepts debug messages, so that hot code paths
+    can skip building the arguments of debug messages (and calling the logger
+    at all) using a single attribute lookup when debug logging is disabled.
+    The switch is updated at the start of each conversion (see update()).
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.update()
+
+    def update(self):
+        """
+        Check whether the logger currently accepts debug messages.
+        """
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+
+debugging = DebugSwitch(logger)
+tracing = DebugSwitch(tracer)
+
 # Mapping of HTML element names to custom Node types.
 name_to_type_mapping = {}
 
@@ -93,55 +192,254 @@ def main():
     """
     Command line interface for html2vimdoc.
     """
-    filename, title, url, arguments, preview, markdown_extensions = parse_args(sys.argv[1:])
-    filename, url, text = get_input(filename, url, arguments, markdown_extensions)
-    vimdoc = html2vimdoc(text, title=title, filename=filename, url=url)
-    output = vimdoc.encode('utf-8')
-    logger.info("Done!")
-    if preview:
-        os.popen("gvim -c 'set nomod' -", 'w').write(output)
+    settings, arguments = parse_args(sys.argv[1:])
+    if settings['batch']:
+        if settings['manifest']:
+            jobs = read_manifest(settings['manifest'])
+        elif len(arguments) % 2 == 0:
+            jobs = zip(arguments[0::2], arguments[1::2])
+        else:
+            print "Batch mode expects pairs of INPUT OUTPUT arguments!"
+            print __doc__.strip()
+            sys.exit(1)
+        if not convert_batch(jobs, settings, workers=settings['jobs']):
+            sys.exit(1)
+        return
+    filename, url, text, markdown_extensions = get_input(settings['filename'], settings['url'],
+                                                         arguments, settings['markdown_extensions'])
+    if settings['tags'] and not filename:
+        print "Writing a tags file requires the name of the help file! (use --file)"
+        print __doc__.strip()
+        sys.exit(1)
+    cache = ConversionCache() if settings['cache'] else None
+    sections = SectionCache() if (settings['cache'] and settings['incremental']) else None
+    tags = TagsFile(settings['tags'], merge=settings['merge_tags']) if settings['tags'] else None
+    stats = ConversionStats() if settings['stats'] else None
+    options = dict(title=settings['title'],
+                   filename=filename,
+                   url=url,
+                   vim_tags=load_vim_tags(settings['vim_tags']),
+                   compact_tree=settings['compact_tree'],
+                   parser=settings['parser'],
+                   markdown_extensions=markdown_extensions,
+                   cache=cache,
+                   sections=sections,
+                   tags=tags,
+                   render_workers=settings['render_workers'],
+                   parallel_threshold=settings['parallel_threshold'],
+                   stats=stats)
+    if settings['preview']:
+        vimdoc = html2vimdoc(text, **options)
+        logger.info("Done!")
+        os.popen("gvim -c 'set nomod' -", 'w').write(vimdoc.encode('utf-8'))
     else:
-        print output
+        stream = codecs.getwriter('utf-8')(sys.stdout)
+        html2vimdoc(text, stream=stream, **options)
+        stream.write(u"\n")
+        logger.info("Done!")
+    if tags:
+        tags.save()
+    if cache:
+        logger.info("Conversion cache: %i hit(s), %i miss(es).", cache.hits, cache.misses)
+    if stats:
+        report_stats(stats.to_dict())
 
 def parse_args(argv):
     """
     Parse the command line arguments given to html2vimdoc.
     """
-    preview = False
-    markdown_extensions = ['fenced_code']
-    filename = ''
-    title = ''
-    url = ''
+    settings = dict(filename='', title='', url='',
+                    markdown_extensions=['fenced_code'],
+                    vim_tags=None, compact_tree=False, cache=True, incremental=False,
+                    tags=None, merge_tags=False,
+                    parser='htmlparser', preview=False,
+                    batch=False, manifest=None, jobs=None,
+                    render_workers=1, parallel_threshold=PARALLEL_THRESHOLD,
+                    stats=None)
     try:
-        options, arguments = getopt.getopt(argv, 'f:t:u:x:pvh', ['file=',
-            'title=', 'url=', 'ext=', 'preview', 'verbose', 'help'])
+        options, arguments = getopt.getopt(argv, 'f:t:u:x:rR:cnig:G:Bbm:j:P:ps:vTh', ['file=',
+            'title=', 'url=', 'ext=', 'runtime-tags', 'vim-tags=', 'compact', 'no-cache', 'incremental', 'tags=',
+            'update-tags=', 'beautifulsoup', 'batch',
+            'manifest=', 'jobs=', 'parallel=', 'parallel-threshold=', 'preview', 'stats=', 'verbose', 'trace', 'help'])
     except getopt.GetoptError, err:
         print str(err)
         print __doc__.strip()
         sys.exit(1)
     for option, value in options:
         if option in ('-f', '--file'):
-            filename = value
+            settings['filename'] = value
         elif option in ('-t', '--title'):
-            title = value
+            settings['title'] = value
         elif option in ('-u', '--url'):
-            url = value
+            settings['url'] = value
         elif option in ('-x', '--ext'):
-            markdown_extensions.append(value)
+            settings['markdown_extensions'].append(value)
+        elif option in ('-r', '--runtime-tags'):
+            settings['vim_tags'] = 'runtime'
+        elif option in ('-R', '--vim-tags'):
+            settings['vim_tags'] = value
+        elif option in ('-c', '--compact'):
+            settings['compact_tree'] = True
+        elif option in ('-n', '--no-cache'):
+            settings['cache'] = False
+        elif option in ('-i', '--incremental'):
+            settings['incremental'] = True
+        elif option in ('-g', '--tags'):
+            settings['tags'] = value
+            settings['merge_tags'] = False
+        elif option in ('-G', '--update-tags'):
+            settings['tags'] = value
+            settings['merge_tags'] = True
+        elif option in ('-B', '--beautifulsoup'):
+            settings['parser'] = 'beautifulsoup'
+        elif option in ('-b', '--batch'):
+            settings['batch'] = True
+        elif option in ('-m', '--manifest'):
+            settings['batch'] = True
+            settings['manifest'] = value
+        elif option in ('-j', '--jobs'):
+            settings['jobs'] = int(value)
+        elif option in ('-P', '--parallel'):
+            settings['render_workers'] = int(value)
+        elif option == '--parallel-threshold':
+            settings['parallel_threshold'] = int(value)
         elif option in ('-p', '--preview'):
-            preview = True
+            settings['preview'] = True
+        elif option in ('-s', '--stats'):
+            if value != 'json':
+                print "Unsupported statistics format %r! (only 'json' is supported)" % value
+                print __doc__.strip()
+                sys.exit(1)
+            settings['stats'] = value
         elif option in ('-v', '--verbose'):
             logger.setLevel(logging.DEBUG)
+        elif option in ('-T', '--trace'):
+            tracer.setLevel(logging.DEBUG)
         elif option in ('-h', '--help'):
             print __doc__.strip()
             sys.exit(0)
         else:
             assert False, "Unknown option"
-    return filename, title, url, arguments, preview, markdown_extensions
+    return settings, arguments
+
+def read_manifest(filename):
+    """
+    Read the INPUT OUTPUT pairs of a batch conversion from a manifest file.
+    """
+    jobs = []
+    with open(filename) as handle:
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                source, target = line.split(None, 1)
+                jobs.append((source, target.strip()))
+    return jobs
+
+def convert_batch(jobs, settings, workers=None):
+    """
+    Convert many documents in a pool of worker processes. The ``jobs`` are
+    (input, output) tuples, the ``settings`` are those returned by
+    ``parse_args()`` and ``workers`` is the number of processes (defaults to
+    the number of CPUs). The tags defined by the converted documents are
+    written to a single tags file (if requested). Returns True when all
+    documents were converted.
+    """
+    tasks = [(source, target, settings) for source, target in jobs]
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    logger.info("Converting %i document(s) using %i worker process(es) ..", len(tasks), workers)
+    start_time = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(convert_file, tasks)
+    else:
+        pool = None
+        results = itertools.imap(convert_file, tasks)
+    failed = 0
+    hits = 0
+    misses = 0
+    tags = TagsFile(settings['tags'], merge=settings['merge_tags']) if settings['tags'] else None
+    for source, target, elapsed_time, error, cache_hits, cache_misses, defined_tags, stats in results:
+        if error:
+            logger.error("Failed to convert %s! (%s)", source, error)
+            failed += 1
+        else:
+            logger.info("Converted %s to %s in %.2f seconds.", source, target, elapsed_time)
+            if tags:
+                tags.update(target, defined_tags)
+            if stats:
+                stats.update(source=source, target=target)
+                report_stats(stats)
+        hits += cache_hits
+        misses += cache_misses
+    if pool:
+        pool.close()
+        pool.join()
+    logger.info("Converted %i document(s) in %.2f seconds (%i failed).",
+                len(tasks), time.time() - start_time, failed)
+    if tags:
+        tags.save()
+    if settings['cache']:
+        logger.info("Conversion cache: %i hit(s), %i miss(es).", hits, misses)
+    return failed == 0
+
+def convert_file(task):
+    """
+    Convert a single document in batch mode. The ``task`` is a tuple with the
+    input location, output filename and settings. Returns a tuple with the
+    input location, output filename, elapsed time, error message (None on
+    success), the number of conversion cache hits and misses, the tags defined
+    by the help file (a list, empty unless requested) and the statistics of
+    the conversion (a dictionary, None unless requested).
+    """
+    source, target, settings = task
+    start_time = time.time()
+    cache = ConversionCache() if settings['cache'] else None
+    sections = SectionCache() if (settings['cache'] and settings['incremental']) else None
+    tags = TagsFile(settings['tags']) if settings['tags'] else None
+    stats = ConversionStats() if settings['stats'] else None
+    try:
+        filename, url, text, markdown_extensions = get_input(os.path.basename(target), settings['url'],
+                                                             [source], settings['markdown_extensions'])
+        vimdoc = html2vimdoc(text, title=settings['title'], filename=filename, url=url,
+                             vim_tags=load_vim_tags(settings['vim_tags']),
+                             compact_tree=settings['compact_tree'],
+                             parser=settings['parser'],
+                             markdown_extensions=markdown_extensions,
+                             cache=cache, sections=sections, tags=tags, stats=stats)
+        with codecs.open(target, 'w', 'utf-8') as handle:
+            handle.write(u"%s\n" % vimdoc)
+        error = None
+    except Exception, e:
+        error = str(e) or e.__class__.__name__
+    return (source, target, time.time() - start_time, error,
+            cache.hits if cache else 0, cache.misses if cache else 0,
+            sum(tags.help_files.values(), []) if tags else [],
+            stats.to_dict() if stats else None)
+
+def load_vim_tags(location):
+    """
+    Open the Vim tags file selected using --runtime-tags or --vim-tags. The
+    ``location`` is None (no tags file), 'runtime' (find Vim's runtime tags
+    file) or a filename. Returns a ``VimTagsIndex`` or None.
+    """
+    if location == 'runtime':
+        location = find_vim_runtime_tags()
+        if not location:
+            logger.warning("Failed to find Vim's runtime tags file! (is $VIMRUNTIME set?)")
+    return VimTagsIndex(location) if location else None
+
+def report_stats(stats):
+    """
+    Write the statistics of a conversion to standard error (as a single line
+    of JSON, so that the statistics of a batch conversion can be processed
+    one document at a time).
+    """
+    sys.stderr.write(json.dumps(stats) + "\n")
 
 def get_input(filename, url, args, markdown_extensions):
     """
-    Get text to be converted from standard input, path name or URL.
+    Get text to be converted from standard input, path name or URL. The
+    returned Markdown extensions are None unless the input is Markdown.
     """
     source = ''
     if not url and not args:
@@ -160,59 +458,147 @@ def get_input(filename, url, args, markdown_extensions):
             # Generate embedded filename from base name of input document.
             filename = os.path.basename(source)
             filename = os.path.splitext(filename)[0] + '.txt'
-    if source.lower().endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown')):
-        text = markdown_to_html(text, markdown_extensions)
-    return filename, url, text
+    if not source.lower().endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown')):
+        markdown_extensions = None
+    return filename, url, text, markdown_extensions
 
-def markdown_to_html(text, markdown_extensions):
+def markdown_to_html(text, markdown_extensions, encoding=None):
     """
-    When the input is Markdown, convert it to HTML so we can parse that.
+    When the input is Markdown, convert it to HTML so we can parse that. Text
+    that isn't Unicode is decoded using the given ``encoding`` (when the
+    caller knows it) or otherwise using the encoding detected by
+    ``UnicodeDammit``.
     """
     logger.info("Converting Markdown to HTML using extensions: %s.", ", ".join(sorted(markdown_extensions)))
-    # We import the markdown module here so that the markdown module is not
-    # required to use html2vimdoc when the input is HTML.
-    from markdown import markdown
-    # The Python Markdown module only accepts Unicode and ASCII strings, but we
-    # don't know what the encoding of the Markdown text is. BeautifulSoup comes
-    # to the rescue with the aptly named UnicodeDammit class :-).
-    return markdown(UnicodeDammit(text).unicode, extensions=markdown_extensions)
-
-def html2vimdoc(html, title='', filename='', url='', content_selector='#content', selectors_to_ignore=[], modeline='vim: ft=help'):
+    if not isinstance(text, unicode):
+        if encoding:
+            text = text.decode(encoding)
+        else:
+            try:
+                # Most README files are plain ASCII, in which case there's
+                # no need to detect the encoding.
+                text = text.decode('ascii')
+            except UnicodeDecodeError:
+                # The Python Markdown module only accepts Unicode and ASCII
+                # strings, but we don't know what the encoding of the Markdown
+                # text is. BeautifulSoup comes to the rescue with the aptly
+                # named UnicodeDammit class :-).
+                text = UnicodeDammit(text).unicode
+    converter = get_markdown_converter(markdown_extensions)
+    converter.reset()
+    return converter.convert(text)
+
+# Markdown converters that are reused between documents, by extensions.
+markdown_converters = {}
+
+def get_markdown_converter(markdown_extensions):
+    """
+    Get a Markdown converter with the given extensions loaded. Loading the
+    extensions takes longer than converting a small README file, so the
+    converters are created once and reset (by the caller) between documents.
+    """
+    key = tuple(markdown_extensions)
+    if key not in markdown_converters:
+        # We import the markdown module here so that the markdown module is not
+        # required to use html2vimdoc when the input is HTML.
+        from markdown import Markdown
+        markdown_converters[key] = Markdown(extensions=list(markdown_extensions))
+    return markdown_converters[key]
+
+def html2vimdoc(html, title='', filename='', url='', content_selector='#content', selectors_to_ignore=[], modeline='vim: ft=help', stream=None, compact_tree=False, parser='htmlparser', markdown_extensions=None, encoding=None, vim_tags=None, cache=None, sections=None, tags=None, render_workers=1, parallel_threshold=PARALLEL_THRESHOLD, stats=None):
     """
-    Convert HTML documents to the Vim help file format.
+    Convert HTML documents to the Vim help file format. If a file-like object
+    is given as ``stream`` the Vim help file is written to the stream (while
+    it's being rendered) instead of being returned as a string. If
+    ``compact_tree`` is True the simplified parse tree is stored in a
+    ``CompactTree`` to reduce memory usage on very large documents (the
+    streaming parser adds the nodes to it while parsing, with BeautifulSoup
+    the tree is copied afterwards, which hardly lowers the peak usage).
+
+    The ``parser`` is either 'htmlparser' (the default, see
+    ``StreamingTreeBuilder``) or 'beautifulsoup' (the original backend).
+
+    When ``markdown_extensions`` is given the input is Markdown text which is
+    converted to HTML (using those extensions) first. When the input isn't
+    Unicode and the caller knows its character ``encoding`` it's used instead
+    of detecting the encoding. When a ``VimTagsIndex`` is given as
+    ``vim_tags`` code fragments that match tags in Vim's documentation are
+    turned into tag references (see ``MarkTags``).
+
+    When a ``ConversionCache`` is given as ``cache`` the result of previous
+    conversions of the same input (with the same options) is reused. When a
+    ``SectionCache`` is given as ``sections`` only the sections of the
+    document that changed since it was previously converted are rendered
+    (see ``render_sections()``). When a ``TagsFile`` is given as ``tags`` the
+    tags defined by the generated help file are added to it (the caller is
+    expected to ``save()`` it).
+
+    When ``render_workers`` is more than one, documents of at least
+    ``parallel_threshold`` parse tree nodes are rendered in a pool of that
+    many worker processes (at most one per CPU, see ``render_parallel()``).
+    This doesn't apply to incremental conversions (when ``sections`` is
+    given) or conversions in a worker process of a batch conversion.
+
+    When a ``ConversionStats`` object is given as ``stats`` it records the
+    time spent in each stage of the conversion and some counters. With the
+    default parser the 'select_title', 'ignore_comments' and 'simplify'
+    stages are part of the 'parse' stage (see ``parse_with_htmlparser()``).
     """
+    debugging.update()
+    tracing.update()
+    if stats is None:
+        stats = ConversionStats(enabled=False)
+    if cache is not None:
+        key = cache.key(html, title=title, filename=filename, url=url,
+                        content_selector=content_selector,
+                        selectors_to_ignore=selectors_to_ignore,
+                        modeline=modeline,
+                        parser=parser,
+                        markdown_extensions=markdown_extensions,
+                        encoding=encoding,
+                        vim_tags=vim_tags.identity if vim_tags is not None else None)
+        vimdoc, defined_tags = cache.get_conversion(key)
+        if vimdoc is not None:
+            logger.info("Reusing cached conversion ..")
+            stats.count(cache_hit=True, output_size=len(vimdoc))
+            if tags is not None:
+                tags.update(filename, defined_tags)
+            stats.measure_memory()
+            if stream is None:
+                return vimdoc
+            stream.write(vimdoc)
+            return
+    if markdown_extensions is not None:
+        with stats.stage('markdown'):
+            html = markdown_to_html(html, markdown_extensions, encoding)
     logger.info("Parsing HTML ..")
-    html = remove_hexadecimal_character_references(html)
-    tree = BeautifulSoup(html, convertEntities=BeautifulSoup.ALL_ENTITIES)
-    logger.info("Transforming contents ..")
-    title = select_title(tree, title)
-    ignore_comments(tree)
-    ignore_given_selectors(tree, selectors_to_ignore)
-    root = find_root_node(tree, content_selector)
-    simple_tree = simplify_node(root)
-    shift_headings(simple_tree)
-    find_references(simple_tree, url)
-    # Add an "Introduction" heading to separate the table of contents from the
-    # start of the document text.
-    simple_tree.contents.insert(0, Heading(level=1, contents=[Text(text="Introduction")]))
-    logger.info("Tagging document headings ..")
-    tagged_headings = tag_headings(simple_tree, filename)
-    logger.info("Marking internal references (pass 1, before TOC) ..")
-    simple_tree = mark_tags(simple_tree, tagged_headings)
-    logger.info("Generating table of contents ..")
-    generate_table_of_contents(simple_tree)
-    logger.info("Marking internal references (pass 2, after TOC) ..")
-    simple_tree = mark_tags(simple_tree, tagged_headings)
-    make_parents_explicit(simple_tree)
-    prune_empty_blocks(simple_tree)
+    if parser == 'beautifulsoup':
+        title, simple_tree = parse_with_beautifulsoup(html, title, content_selector, selectors_to_ignore, stats, encoding, compact_tree)
+    else:
+        title, simple_tree = parse_with_htmlparser(html, title, content_selector, selectors_to_ignore, stats, encoding, compact_tree)
+    index = NodeIndex.create(simple_tree)
+    logger.info("Tagging headings, marking references and generating table of contents ..")
+    heading_tags = TagHeadings(index, filename)
+    num_traversals = run_passes(index, [
+        ShiftHeadings(index),
+        FindReferences(index, url),
+        AddIntroduction(index),
+        heading_tags,
+        MarkTags(index, heading_tags.tags, vim_tags),
+        TableOfContents(index),
+        PruneEmptyBlocks(index),
+    ], stats)
+    stats.count(traversals=num_traversals)
+    # Empty headings are tagged (using the prefix of the tags) before they're
+    # pruned, their tags aren't defined by the help file.
+    tagged_headings = dict((tag, heading) for tag, heading in heading_tags.tags.iteritems() if heading)
+    defined_tags = ([filename] if filename else []) + tagged_headings.keys()
+    if tags is not None:
+        tags.update(filename, defined_tags)
     logger.info("Rendering output ..")
-    vimdoc = simple_tree.render(indent=0)
-    output = list(flatten(vimdoc))
-    logger.debug("Output strings before deduplication: %s", list(unicode(v) for v in output))
-    deduplicate_delimiters(output)
-    logger.debug("Output strings after deduplication: %s", list(unicode(v) for v in output))
-    # Render the final text.
-    vimdoc = u"".join(unicode(v) for v in output)
+    # Stream the output to the caller unless we need the complete text.
+    buffer = io.StringIO() if (stream is None or cache is not None) else None
+    writer = OutputWriter(stats.count_output(stream if buffer is None else buffer))
     # Add the first line with the file tag and/or document title?
     if title or filename:
         firstline = []
@@ -220,11 +606,549 @@ def html2vimdoc(html, title='', filename='', url='', content_selector='#content'
             firstline.append("*%s*" % filename)
         if title:
             firstline.append(title)
-        vimdoc = "%s\n\n%s" % ("  ".join(firstline), vimdoc)
+        writer.stream.write(unicode("%s\n\n" % "  ".join(firstline)))
+    with stats.stage('render'):
+        if sections is not None:
+            num_sections, num_reused = render_sections(simple_tree, writer, sections, indent=0, in_heading=False, index=index)
+            logger.info("Reused %i of %i rendered section(s).", num_reused, num_sections)
+            stats.count(sections=num_sections, sections_reused=num_reused)
+        elif render_workers > 1 and index.count_descendants(simple_tree) >= parallel_threshold \
+                and not multiprocessing.current_process().daemon:
+            num_sections, num_workers = render_parallel(simple_tree, writer, render_workers, indent=0, in_heading=False, index=index)
+            logger.info("Rendered %i section(s) using %i worker process(es).", num_sections, num_workers)
+            stats.count(sections=num_sections, render_workers=num_workers)
+        else:
+            render_document(simple_tree, writer, indent=0, in_heading=False, index=index)
+        writer.close()
     # Add a mode line at the end of the document.
     if modeline and not modeline.isspace():
-        vimdoc += "\n\n" + modeline
-    return vimdoc
+        writer.stream.write(unicode("\n\n" + modeline))
+    if stats.enabled:
+        stats.count_nodes(index, tagged_headings)
+        stats.count(cache_hit=False, output_size=writer.stream.size)
+        stats.measure_memory()
+    if buffer is not None:
+        vimdoc = buffer.getvalue()
+        if cache is not None:
+            cache.put_conversion(key, vimdoc, defined_tags)
+        if stream is None:
+            return vimdoc
+        stream.write(vimdoc)
+
+class ConversionCache(object):
+
+    """
+    On disk cache of converted documents. The cache key is a hash of the input
+    text, the conversion options and the converter version (see
+    ``get_converter_version()``), the value is the generated Vim help file
+    and the tags it defines (see ``get_conversion()``).
+    When the total size of the cache exceeds its limit the least recently
+    used entries are evicted (based on modification times, which are updated
+    on every cache hit).
+    """
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.version = get_converter_version()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text, **options):
+        """
+        Compute the cache key for the given input text and options.
+        """
+        context = hashlib.sha1()
+        context.update(self.version)
+        context.update(json.dumps(options, sort_keys=True))
+        context.update(text.encode('utf-8') if isinstance(text, unicode) else text)
+        return context.hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached conversion (returns None on a cache miss).
+        """
+        filename = os.path.join(self.directory, '%s.txt' % key)
+        try:
+            with codecs.open(filename, 'r', 'utf-8') as handle:
+                vimdoc = handle.read()
+            # Mark the entry as recently used.
+            os.utime(filename, None)
+        except (IOError, OSError):
+            logger.debug("Conversion cache miss: %s", key)
+            self.misses += 1
+            return None
+        logger.debug("Conversion cache hit: %s", key)
+        self.hits += 1
+        return vimdoc
+
+    def get_conversion(self, key):
+        """
+        Get a cached conversion as a tuple with the generated Vim help file
+        and the tags it defines (both None on a cache miss). The tags are
+        stored with the help file, so that the tags file written after a
+        cache hit is the same as after a conversion.
+        """
+        value = self.get(key)
+        if value is None:
+            return None, None
+        entry = json.loads(value)
+        return entry['vimdoc'], entry['tags']
+
+    def put_conversion(self, key, vimdoc, tags):
+        """
+        Store a conversion (the generated Vim help file and the list of tags
+        it defines) in the cache.
+        """
+        self.put(key, json.dumps(dict(vimdoc=vimdoc, tags=tags)))
+
+    def put(self, key, vimdoc, evict=True):
+        """
+        Store a conversion in the cache and evict old entries if necessary
+        (unless ``evict`` is False, because the caller is going to store more
+        entries and call ``evict()`` afterwards).
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file and rename it so that concurrent
+            # readers never see partially written entries.
+            fd, temporary_file = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as handle:
+                handle.write(vimdoc.encode('utf-8'))
+            os.rename(temporary_file, os.path.join(self.directory, '%s.txt' % key))
+            if evict:
+                self.evict()
+        except (IOError, OSError), e:
+            logger.warning("Failed to update conversion cache in %s! (%s)", self.directory, e)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its limit.
+        """
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.txt'):
+                filename = os.path.join(self.directory, name)
+                try:
+                    status = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, filename))
+                total_size += status.st_size
+        entries.sort()
+        while entries and total_size > self.max_size:
+            mtime, size, filename = entries.pop(0)
+            logger.debug("Evicting %s from conversion cache ..", filename)
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total_size -= size
+
+class SectionCache(ConversionCache):
+
+    """
+    On disk cache of the rendered output of document sections (see
+    ``render_sections()``). The cache key is a hash of the parse tree of a
+    section (see ``fingerprint_section()``), the value is the rendered output
+    of the section before the delimiters are merged, so that a section from
+    the cache and a freshly rendered section are combined in exactly the same
+    way by the ``OutputWriter``.
+    """
+
+    def __init__(self, directory=SECTION_CACHE_DIRECTORY, max_size=CACHE_SIZE):
+        ConversionCache.__init__(self, directory, max_size)
+
+    def get_output(self, key):
+        """
+        Get the cached output of a section as a list of strings and
+        ``OutputDelimiter`` objects (None on a cache miss).
+        """
+        value = self.get(key)
+        if value is not None:
+            return [OutputDelimiter(string) if is_delimiter else string
+                    for is_delimiter, string in json.loads(value)]
+
+    def put_output(self, key, output):
+        """
+        Store the output of a section (a list of strings and
+        ``OutputDelimiter`` objects) in the cache. Doesn't evict old entries.
+        """
+        value = json.dumps([(isinstance(v, OutputDelimiter), unicode(v)) for v in output])
+        self.put(key, value, evict=False)
+
+class TagsFile(object):
+
+    """
+    Vim help tags file (usually ``doc/tags``) that makes it possible to jump
+    to the tags defined by help files without running Vim's ``:helptags``
+    command. Each line has the form ``tag<Tab>file<Tab>/*tag*`` and the lines
+    are sorted by byte value, so that Vim can binary search the file.
+
+    The tags of each converted help file are given to ``update()``. When the
+    file is saved the existing entries of those help files are replaced,
+    while the entries of other help files are kept (unless ``merge`` is
+    False, in which case the file only contains the given help files).
+    """
+
+    encoding_header = '!_TAG_FILE_ENCODING\tutf-8\t//'
+
+    def __init__(self, filename, merge=True):
+        self.filename = filename
+        self.merge = merge
+        self.help_files = collections.OrderedDict()
+
+    def update(self, help_file, tags):
+        """
+        Set the tags defined by the given help file (the name of the help file
+        should be relative to the directory containing the tags file).
+        """
+        self.help_files[os.path.basename(help_file)] = list(tags)
+
+    def save(self):
+        """
+        Write the tags file (atomically, by renaming a temporary file).
+        """
+        lines = []
+        if self.merge:
+            lines.extend(self.read_other_entries())
+        for help_file, tags in self.help_files.iteritems():
+            for tag in tags:
+                lines.append(self.format_entry(tag, help_file))
+        lines.sort()
+        self.report_duplicates(lines)
+        if any(not all(ord(c) < 128 for c in l) for l in lines):
+            lines.insert(0, self.encoding_header)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        logger.info("Writing %i tag(s) to %s ..", len(lines), self.filename)
+        fd, temporary_file = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as handle:
+            for line in lines:
+                handle.write("%s\n" % line)
+        os.rename(temporary_file, self.filename)
+
+    def read_other_entries(self):
+        """
+        Read the entries of the existing tags file that belong to help files
+        other than the ones given to ``update()``.
+        """
+        entries = []
+        try:
+            with open(self.filename) as handle:
+                for line in handle:
+                    line = line.rstrip('\r\n')
+                    if line and not line.startswith('!_TAG_'):
+                        fields = line.split('\t')
+                        if len(fields) >= 3 and fields[1] not in self.help_files:
+                            entries.append(line)
+        except IOError:
+            logger.debug("Tags file %s doesn't exist yet.", self.filename)
+        return entries
+
+    def format_entry(self, tag, help_file):
+        """
+        Format the line of a tags file that defines the given tag (as a UTF-8
+        encoded string, because Vim sorts and searches tags files by bytes).
+        In the search command backslashes and slashes are escaped.
+        """
+        if isinstance(tag, unicode):
+            tag = tag.encode('utf-8')
+        if isinstance(help_file, unicode):
+            help_file = help_file.encode('utf-8')
+        pattern = re.sub(r'([\\/])', r'\\\1', tag)
+        return "%s\t%s\t/*%s*" % (tag, help_file, pattern)
+
+    def report_duplicates(self, lines):
+        """
+        Warn about tags that are defined more than once (Vim's ``:helptags``
+        command also complains about these, because only one of the
+        definitions can be reached).
+        """
+        previous = None
+        for line in lines:
+            tag = line.split('\t', 1)[0]
+            if tag == previous:
+                logger.warning("Duplicate tag %r in %s!", tag, self.filename)
+            previous = tag
+
+class VimTagsIndex(object):
+
+    """
+    Read only view of a sorted Vim tags file (like ``$VIMRUNTIME/doc/tags``)
+    used to find out whether code fragments refer to tags defined by Vim's
+    documentation. The file is memory mapped and searched using binary search
+    (the same way Vim searches tags files) so it's never read into memory as
+    a whole. The results of lookups are remembered because the same code
+    fragments tend to occur many times in a document.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        status = os.stat(filename)
+        # Identifies the contents of the tags file in cache keys.
+        self.identity = '%s:%i:%i' % (os.path.abspath(filename), status.st_size, status.st_mtime)
+        self.lookups = {}
+        with open(filename, 'rb') as handle:
+            if status.st_size > 0:
+                self.data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''
+
+    def __contains__(self, tag):
+        if tag not in self.lookups:
+            self.lookups[tag] = self.search(tag.encode('utf-8') if isinstance(tag, unicode) else tag)
+        return self.lookups[tag]
+
+    def search(self, tag):
+        """
+        Binary search the tags file for a line whose first field is the given
+        tag (a byte string). Both ends of the search range are kept at the
+        start of a line.
+        """
+        data = self.data
+        low = 0
+        high = len(data)
+        while low < high:
+            middle = (low + high) // 2
+            start = data.rfind('\n', 0, middle) + 1
+            end = data.find('\n', start)
+            if end < 0:
+                end = len(data)
+            separator = data.find('\t', start, end)
+            key = data[start:separator if separator >= 0 else end]
+            if key == tag:
+                return True
+            elif key < tag:
+                low = end + 1
+            else:
+                high = start
+        return False
+
+def find_vim_runtime_tags():
+    """
+    Find the tags file of Vim's documentation (returns None if it can't be
+    found). Looks in ``$VIMRUNTIME/doc`` and the usual installation
+    directories (preferring the most recent version of Vim).
+    """
+    candidates = []
+    if os.environ.get('VIMRUNTIME'):
+        candidates.append(os.path.join(os.environ['VIMRUNTIME'], 'doc', 'tags'))
+    for pattern in ('/usr/local/share/vim/vim[0-9]*/doc/tags',
+                    '/usr/share/vim/vim[0-9]*/doc/tags',
+                    '/Applications/MacVim.app/Contents/Resources/vim/runtime/doc/tags'):
+        candidates.extend(sorted(glob.glob(pattern), reverse=True))
+    for filename in candidates:
+        if os.path.isfile(filename):
+            logger.debug("Found Vim's runtime tags file: %s", filename)
+            return filename
+
+class ConversionStats(object):
+
+    """
+    Instrumentation of ``html2vimdoc()``. Records the wall clock time and CPU
+    time spent in each stage of a conversion and some counters: the number of
+    nodes of each type in the final parse tree, the number of headings,
+    references and tags, the size of the output (in characters) and the peak
+    memory usage. ``to_dict()`` returns the results as a dictionary (which can
+    be serialized as JSON).
+
+    The memory usage is the peak resident set size of the process reported by
+    the operating system (there's no tracemalloc in Python 2), so it includes
+    the interpreter and any documents converted earlier by the same process.
+
+    A disabled instance (which ``html2vimdoc()`` uses when the caller doesn't
+    ask for statistics) doesn't measure anything.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager that measures the time spent in the named stage. When
+        a stage is entered more than once the times are added up.
+        """
+        if not self.enabled:
+            yield
+            return
+        timings = self.stages.setdefault(name, collections.OrderedDict([('wall_time', 0.0), ('cpu_time', 0.0)]))
+        wall_time = time.time()
+        cpu_time = get_cpu_time()
+        try:
+            yield
+        finally:
+            timings['wall_time'] += time.time() - wall_time
+            timings['cpu_time'] += get_cpu_time() - cpu_time
+
+    def timed(self, name, function):
+        """
+        Wrap a function so that the time spent in each call is added to the
+        named stage (used for functions that are called many times, like the
+        ``visit()`` methods of passes). Returns the function as is when the
+        instance is disabled.
+        """
+        if not self.enabled:
+            return function
+        timings = self.stages.setdefault(name, collections.OrderedDict([('wall_time', 0.0), ('cpu_time', 0.0)]))
+        def wrapper(*args, **kw):
+            wall_time = time.time()
+            cpu_time = get_cpu_time()
+            try:
+                return function(*args, **kw)
+            finally:
+                timings['wall_time'] += time.time() - wall_time
+                timings['cpu_time'] += get_cpu_time() - cpu_time
+        return wrapper
+
+    def count(self, **counters):
+        """
+        Record the given counters.
+        """
+        if self.enabled:
+            self.counters.update(counters)
+
+    def count_nodes(self, index, tags):
+        """
+        Count the nodes of the parse tree (given as a ``NodeIndex``) by type
+        and record the number of headings, references and tags (given as the
+        mapping of tags to headings collected by ``TagHeadings``).
+        """
+        index.update()
+        nodes = collections.OrderedDict(sorted((node_type.__name__, len(positions))
+                                               for node_type, positions in index.by_type.iteritems()))
+        self.count(nodes=nodes,
+                   headings=nodes.get('Heading', 0),
+                   references=nodes.get('Reference', 0),
+                   tags=len(tags),
+                   tag_references=nodes.get('TagReference', 0))
+
+    def count_output(self, stream):
+        """
+        Wrap the output stream to count the number of characters written to
+        it (see ``CountingStream``). Returns the stream as is when disabled.
+        """
+        return CountingStream(stream) if self.enabled else stream
+
+    def measure_memory(self):
+        """
+        Record the peak memory usage of the process (in bytes).
+        """
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, Mac OS X reports bytes.
+        self.count(peak_memory=peak if sys.platform == 'darwin' else peak * 1024)
+
+    def to_dict(self):
+        """
+        Get the recorded statistics as a dictionary with the keys 'stages' (a
+        mapping of stage names to dictionaries with 'wall_time' and
+        'cpu_time' in seconds), 'total' (the sum of the stages) and
+        'counters' (sorted by name).
+        """
+        total = collections.OrderedDict([('wall_time', 0.0), ('cpu_time', 0.0)])
+        for timings in self.stages.itervalues():
+            total['wall_time'] += timings['wall_time']
+            total['cpu_time'] += timings['cpu_time']
+        return collections.OrderedDict([('stages', self.stages),
+                                        ('total', total),
+                                        ('counters', collections.OrderedDict(sorted(self.counters.items())))])
+
+class CountingStream(object):
+
+    """
+    Wrapper for a file-like object that counts the number of characters
+    written to it (available as the ``size`` attribute).
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+        self.stream.write(text)
+
+def get_cpu_time():
+    """
+    Get the CPU time (user and system) used by the current process.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+def get_converter_version():
+    """
+    Get a string that identifies the version of the conversion logic. It's a
+    hash of the source code of html2vimdoc and soupselect, so that changes to
+    either one invalidate previously cached conversions.
+    """
+    context = hashlib.sha1()
+    for module in (sys.modules[__name__], soupselect):
+        filename = re.sub(r'\.py[co]$', '.py', module.__file__)
+        with open(filename) as handle:
+            context.update(handle.read())
+    return context.hexdigest()
+
+def parse_with_beautifulsoup(html, title, content_selector, selectors_to_ignore, stats=None, encoding=None, compact_tree=False):
+    """
+    Parse an HTML document using BeautifulSoup and simplify the parse tree.
+    Returns a tuple with the document title and the simplified parse tree.
+    The ``encoding`` of the document is detected unless given. If
+    ``compact_tree`` is True the simplified parse tree is copied into a
+    ``CompactTree`` (the BeautifulSoup parse tree is built in full anyway).
+    """
+    stats = stats or ConversionStats(enabled=False)
+    with stats.stage('parse'):
+        html = remove_hexadecimal_character_references(html)
+        tree = BeautifulSoup(html, convertEntities=BeautifulSoup.ALL_ENTITIES, fromEncoding=encoding)
+    logger.info("Transforming contents ..")
+    with stats.stage('select_title'):
+        title = select_title(tree, title)
+    with stats.stage('ignore_comments'):
+        ignore_comments(tree)
+    with stats.stage('simplify'):
+        ignored = compile_ignored_selectors(selectors_to_ignore)
+        root = find_root_node(tree, content_selector, ignored)
+        if root is not None:
+            ignore_given_selectors(root, ignored)
+        root = simplify_node(root)
+    if compact_tree:
+        with stats.stage('compact_tree'):
+            root = CompactTree.pack(root)
+    return title, root
+
+def parse_with_htmlparser(html, title, content_selector, selectors_to_ignore, stats=None, encoding=None, compact_tree=False):
+    """
+    Parse an HTML document using the ``StreamingTreeBuilder``, falling back to
+    BeautifulSoup for documents that HTMLParser can't handle. Returns a tuple
+    with the document title and the simplified parse tree. The title, comments
+    and ignored elements are handled (and the tree is simplified) while the
+    document is being parsed, so the statistics only contain a 'parse' stage.
+    The ``encoding`` of the document is detected unless given. If
+    ``compact_tree`` is True the nodes are stored in a ``CompactTree`` as
+    soon as they're created.
+    """
+    stats = stats or ConversionStats(enabled=False)
+    with stats.stage('parse'):
+        if not isinstance(html, unicode):
+            if encoding:
+                html = html.decode(encoding)
+            else:
+                # Detect the character encoding the same way BeautifulSoup does.
+                html = UnicodeDammit(html, smartQuotesTo=None, isHTML=True).unicode or u''
+        builder = StreamingTreeBuilder(content_selector, selectors_to_ignore, compact_tree)
+        try:
+            builder.feed(html)
+            builder.close()
+        except HTMLParser.HTMLParseError, e:
+            error = e
+        else:
+            return title or builder.title, builder.root
+    logger.warning("Failed to parse HTML using HTMLParser, falling back to BeautifulSoup! (%s)", error)
+    return parse_with_beautifulsoup(html, title, content_selector, selectors_to_ignore, stats, encoding, compact_tree)
 
 def select_title(tree, title):
     """
@@ -244,36 +1168,6 @@ def select_title(tree, title):
         headings[0].extract()
     return title
 
-def deduplicate_delimiters(output):
-    """
-    Deduplicate redundant block delimiters from the rendered Vim help text.
-    """
-    i = 0
-    while i < len(output) - 1:
-        if isinstance(output[i], OutputDelimiter) and isinstance(output[i + 1], OutputDelimiter):
-            if output[i].string.isspace() and not output[i + 1].string.isspace():
-                output.pop(i)
-                continue
-            elif output[i + 1].string.isspace() and not output[i].string.isspace():
-                output.pop(i + 1)
-                continue
-            elif len(output[i].string) < len(output[i + 1].string):
-                output.pop(i)
-                continue
-            elif len(output[i].string) > len(output[i + 1].string):
-                output.pop(i + 1)
-                continue
-            elif output[i].string.isspace():
-                output.pop(i)
-                continue
-        i += 1
-    # Strip leading block delimiters.
-    while output and isinstance(output[0], OutputDelimiter) and output[0].string.isspace():
-        output.pop(0)
-    # Strip trailing block delimiters.
-    while output and isinstance(output[-1], OutputDelimiter) and output[-1].string.isspace():
-        output.pop(-1)
-
 def remove_hexadecimal_character_references(html):
     """
     BeautifulSoup doesn't support hexadecimal character references but it does
@@ -286,24 +1180,48 @@ def remove_hexadecimal_character_references(html):
         return '&#%d;' % code_point
     return re.sub(r'&#x([0-9A-Fa-f]+);', hex_to_dec_entity, html)
 
-def find_root_node(tree, selector):
+def find_root_node(tree, selector, ignored=None):
     """
     Given a document tree generated by BeautifulSoup, find the most
     specific document node that doesn't "lose any information" (i.e.
     everything that we want to be included in the Vim help file) while
     ignoring as much fluff as possible (e.g. headers, footers and
     navigation menus included in the original HTML document).
+
+    Elements that would be removed by ``ignore_given_selectors()`` (given as
+    a compiled selector) are skipped, so the ignored elements only need to
+    be removed from the subtree of the root node.
     """
     # Try to find the root node using a CSS selector provided by the caller.
-    matches = soupselect.select(tree, selector)
-    if matches:
-        return matches[0]
+    root = find_first_element(tree, selector, ignored)
+    if root is not None:
+        return root
     # Otherwise we'll fall back to the <body> element.
-    try:
-        return tree.html.body
-    except:
+    html = find_first_element(tree, 'html', ignored)
+    if html is None:
         # Don't break when html.body doesn't exist.
         return tree
+    return find_first_element(html, 'body', ignored)
+
+def find_first_element(tree, selector, ignored=None):
+    """
+    Find the first element matching a CSS selector that isn't (inside) an
+    element matching the compiled selector of ignored elements.
+    """
+    for element in soupselect.iselect(tree, selector):
+        if not (ignored and is_ignored(element, ignored)):
+            return element
+
+def is_ignored(element, ignored):
+    """
+    Check whether an element or one of its ancestors matches the compiled
+    selector of ignored elements.
+    """
+    while soupselect.is_element(element):
+        if ignored.matches(element):
+            return True
+        element = element.parent
+    return False
 
 def ignore_comments(tree):
     """
@@ -312,248 +1230,577 @@ def ignore_comments(tree):
     for html_node in tree.findAll(text = lambda n: isinstance(n, Comment)):
         html_node.extract()
 
-def ignore_given_selectors(tree, selectors_to_ignore):
+def compile_ignored_selectors(selectors_to_ignore):
+    """
+    Combine the CSS selectors of the elements to ignore into a single
+    compiled selector list (which never matches when there are none).
+    """
+    return soupselect.compile_selector(', '.join(selectors_to_ignore))
+
+def ignore_given_selectors(tree, ignored):
     """
-    Remove all HTML elements matching any of the CSS selectors provided by
-    the caller from the parse tree generated by BeautifulSoup.
+    Remove all HTML elements matching the compiled selector returned by
+    ``compile_ignored_selectors()`` from (a subtree of) the parse tree
+    generated by BeautifulSoup. All of the selectors are tested in a
+    single traversal that skips the contents of removed elements.
     """
-    for selector in selectors_to_ignore:
-        for element in soupselect.select(tree, selector):
-            element.extract()
+    for element in list(ignored.iselect(tree, nested=False)):
+        element.extract()
 
 def simplify_node(html_node):
     """
-    Recursive function to simplify parse trees generated by BeautifulSoup into
-    something we can more easily convert into HTML.
+    Simplify parse trees generated by BeautifulSoup into something we can more
+    easily convert into Vim help text. The tree is walked using an explicit
+    stack instead of recursion (so that deeply nested documents don't exceed
+    Python's recursion limit): The children of an element are simplified
+    before the element itself, which is then simplified by
+    ``simplify_element()`` as a ``SoupElement`` whose contents are the
+    simplified children.
     """
+    # Nodes created by the streaming parser are already simplified.
+    if isinstance(html_node, Node):
+        return html_node
+    simplified = []
+    pending = [(html_node, False)]
+    while pending:
+        html_node, expanded = pending.pop()
+        if expanded:
+            first = len(simplified) - len(html_node.contents)
+            element = SoupElement(html_node, simplified[first:])
+            del simplified[first:]
+            simplified.append(simplify_element(element))
+        elif html_node is None or isinstance(html_node, (Node, NavigableString)):
+            simplified.append(simplify_element(html_node))
+        else:
+            pending.append((html_node, True))
+            pending.extend((child, False) for child in reversed(html_node.contents))
+    return simplified[0]
+
+def simplify_element(html_node):
+    """
+    Simplify a single node of a parse tree, given as a text node or as an
+    element whose contents have already been simplified (a ``SoupElement``
+    or an ``HTMLElement`` created by ``StreamingTreeBuilder``).
+    """
+    # Nodes created by the streaming parser are already simplified.
+    if isinstance(html_node, Node):
+        return html_node
     # First we'll get text nodes out of the way since they're very common.
     if isinstance(html_node, NavigableString):
         internal_node = Text.parse(html_node)
-        logger.debug("Mapping text %r -> %r", html_node, internal_node)
+        if tracing.enabled:
+            tracer.debug("Mapping text %r -> %r", html_node, internal_node)
         return internal_node
     # Now we deal with all of the known & supported HTML elements.
     name = getattr(html_node, 'name', None)
     if name in name_to_type_mapping:
         mapped_type = name_to_type_mapping[name]
         internal_node = mapped_type.parse(html_node)
-        logger.debug("Mapping HTML element <%s> -> %r", name, internal_node)
+        if tracing.enabled:
+            tracer.debug("Mapping HTML element <%s> -> %r", name, internal_node)
         return internal_node
     # Finally we improvise, trying not to lose information.
     internal_node = simplify_children(html_node)
-    logger.debug("Not a supported element! Improvising to preserve content.")
+    if tracing.enabled:
+        tracer.debug("Not a supported element! Improvising to preserve content.")
     return internal_node
 
 def simplify_children(node):
     """
     Simplify the child nodes of the given node taken from a parse tree
-    generated by BeautifulSoup.
+    generated by BeautifulSoup (usually they have already been simplified by
+    ``simplify_node()``).
     """
-    contents = []
-    for child in getattr(node, 'contents', []):
-        contents.append(simplify_node(child))
+    contents = [child if isinstance(child, Node) else simplify_node(child)
+                for child in getattr(node, 'contents', [])]
     if is_block_level(contents):
-        logger.debug("Sequence contains some block level elements")
+        if tracing.enabled:
+            tracer.debug("Sequence contains some block level elements")
         return BlockLevelSequence(contents=contents)
     else:
-        logger.debug("Sequence contains only inline elements")
+        if tracing.enabled:
+            tracer.debug("Sequence contains only inline elements")
         return InlineSequence(contents=contents)
 
-def shift_headings(root):
+class StreamingTreeBuilder(HTMLParser.HTMLParser):
+
     """
-    Perform an intermediate pass over the simplified parse tree to shift
-    headings in such a way that top level headings have level 1.
+    Event driven alternative to building a BeautifulSoup parse tree and
+    simplifying it afterwards: The simplified parse tree nodes are created
+    while the HTML document is being parsed, using the ``parse()`` methods
+    of the node types in ``name_to_type_mapping``.
+
+    - Comments, elements matching the ignored selectors and the first
+      ``<h1>`` element (see ``select_title()``) are dropped on the fly.
+    - Named, decimal and hexadecimal character references are decoded by
+      the builder (so ``remove_hexadecimal_character_references()`` isn't
+      needed). Unknown named references become ``&amp;name`` (as with
+      BeautifulSoup, which assumes a misplaced ampersand).
+    - The contents of ``<script>`` and ``<textarea>`` elements are literal
+      text (markup and character references aren't parsed) while the
+      contents of ``<style>`` elements are parsed like any other element,
+      because that's what BeautifulSoup does (see ``QUOTE_TAGS``).
+    - Open elements are closed implicitly and whitespace is collapsed the
+      same way BeautifulSoup does it (the nesting rules are taken from the
+      ``BeautifulSoup`` class) so both backends create the same tree.
+
+    Once the first element matching the content selector (see
+    ``find_root_node()``) has been closed the rest of the document is parsed
+    without creating any nodes. After ``close()`` the ``title`` and ``root``
+    attributes contain the document title and the simplified parse tree.
+
+    If ``compact_tree`` is True every node is added to a ``CompactTree`` as
+    soon as it has been created (its children are already in the tree), so
+    the object tree is never built: Only the nodes of the open elements
+    exist as views (see ``NodeView``).
     """
-    # Find the largest headings (lowest level).
-    min_level = None
-    logger.debug("Finding largest headings ..")
-    for node in walk_tree(root, Heading):
-        if min_level is None:
-            min_level = node.level
-        elif node.level < min_level:
-            min_level = node.level
-    if min_level is None:
-        logger.debug("HTML document doesn't contain any headings?")
-        return
-    else:
-        logger.debug("Largest headings have level %i.", min_level)
-    # Shift the headings if necessary.
-    if min_level > 1:
-        to_subtract = min_level - 1
-        logger.debug("Shifting headings by %i levels.", to_subtract)
-        for node in walk_tree(root, Heading):
-            node.level -= to_subtract
-
-def tag_headings(root, filename):
-    """
-    Generate Vim help file tags for headings.
-    """
-    tagged_headings = {}
-    # Use base name of filename of help file as prefix (scope) for tags.
-    prefix = re.sub(r'\.txt$', '', filename)
-    logger.debug("Vim help file name without file extension: %r", prefix)
-    # If the base name ends in a version number, we'll strip it.
-    prefix = re.sub(r'-\d+(\.\d+)*$', '', prefix)
-    logger.debug("Tagging headings using prefix %r ..", prefix)
-    for node in walk_tree(root, Heading):
-        logger.debug("Selecting tag for heading: %s", node)
-        tag = node.tag_heading(tagged_headings, prefix)
-        if tag:
-            logger.debug("Found suitable tag: %s", tag)
-            tagged_headings[tag] = node
-    return tagged_headings
 
-def mark_tags(root, tags):
+    # The elements whose contents are literal text.
+    CDATA_CONTENT_ELEMENTS = tuple(sorted(BeautifulSoup.QUOTE_TAGS))
+
+    def __init__(self, content_selector='#content', selectors_to_ignore=[], compact_tree=False):
+        HTMLParser.HTMLParser.__init__(self)
+        self.tree = CompactTree() if compact_tree else None
+        self.content_selector = soupselect.compile_selector(content_selector)
+        self.ignored = compile_ignored_selectors(selectors_to_ignore)
+        self.strings = []
+        self.document = HTMLElement(self, BeautifulSoup.ROOT_TAG_NAME, {}, None)
+        self.stack = [self.document]
+        self.pending_text = []
+        self.preserve_whitespace = 0
+        self.title = ''
+        self.title_element = None
+        self.title_strings = []
+        self.heading_removed = False
+        self.content_element = None
+        self.html_element = None
+        self.body_element = None
+        self.finished = False
+        self.root = None
+
+    def handle_starttag(self, name, attrs, self_closing=False):
+        self.flush_text()
+        is_void = self_closing or name in BeautifulSoup.SELF_CLOSING_TAGS
+        if not is_void:
+            self.close_implicitly(name)
+        parent = self.stack[-1]
+        # Attributes without a value are given their name as value (like
+        # sgmllib does, which is used by BeautifulSoup).
+        element = HTMLElement(self, name, dict((k, k if v is None else v) for k, v in attrs), parent)
+        # The document title is the text of the first <title> or <h1> element.
+        if self.title_element is None and name in ('title', 'h1'):
+            self.title_element = element
+        if name == 'h1' and not self.heading_removed:
+            # The first top level heading is removed from the tree.
+            self.heading_removed = True
+            element.ignored = True
+        elif self.finished or parent.ignored:
+            element.ignored = True
+        else:
+            element.ignored = self.ignored.matches(element)
+        if not element.ignored:
+            # Remember the candidates for the root node.
+            if self.content_element is None and self.content_selector.matches(element):
+                self.content_element = element
+            if name == 'html' and self.html_element is None:
+                self.html_element = element
+            elif name == 'body' and self.body_element is None and self.html_element and self.html_element.is_open:
+                self.body_element = element
+        self.stack.append(element)
+        if name in BeautifulSoup.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace += 1
+        if is_void:
+            self.pop_element()
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, self_closing=True)
+
+    def handle_endtag(self, name):
+        self.flush_text()
+        for i in xrange(len(self.stack) - 1, 0, -1):
+            if self.stack[i].name == name:
+                while len(self.stack) > i:
+                    self.pop_element()
+                break
+
+    def handle_data(self, data):
+        self.pending_text.append(data)
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                self.pending_text.append(unichr(int(name[1:], 16)))
+            else:
+                self.pending_text.append(unichr(int(name)))
+        except (ValueError, OverflowError):
+            self.pending_text.append(u'&#%s;' % name)
+
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.pending_text.append(unichr(htmlentitydefs.name2codepoint[name]))
+        elif name == 'apos':
+            self.pending_text.append(u"'")
+        else:
+            # Unknown entities are most likely misplaced ampersands;
+            # BeautifulSoup escapes the ampersand and drops the semicolon.
+            self.pending_text.append(u'&amp;' + name)
+
+    def handle_comment(self, data):
+        self.flush_text()
+        # Comments are only part of the document title (BeautifulSoup
+        # includes them in the text of the <title> element).
+        if self.title_element is not None and self.title_element.is_open:
+            self.title_strings.append(self.collapse_whitespace(data))
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        self.flush_text()
+        while len(self.stack) > 1:
+            self.pop_element()
+        if self.content_element:
+            self.root = self.content_element.node
+        elif self.html_element:
+            self.root = self.body_element.node if self.body_element else self.pack(simplify_element(None))
+        else:
+            self.root = self.pack(simplify_element(self.document))
+        if self.tree is not None:
+            logger.debug("Packed %i nodes (%i unique strings) into compact tree.", len(self.tree.kinds), len(self.tree.strings))
+
+    def close_implicitly(self, name):
+        """
+        Close the open elements that can't contain an element with the given
+        name (this mimics ``BeautifulSoup._smartPop()``).
+        """
+        reset_triggers = BeautifulSoup.NESTABLE_TAGS.get(name)
+        is_nestable = reset_triggers is not None
+        if is_nestable and not reset_triggers:
+            # Elements like <div> and <span> never close other elements
+            # (no need to search the stack, which can be very deep).
+            return
+        is_reset_nesting = name in BeautifulSoup.RESET_NESTING_TAGS
+        for i in xrange(len(self.stack) - 1, 0, -1):
+            other = self.stack[i].name
+            if other == name and not is_nestable:
+                # Non-nestable elements close their previous occurrence.
+                while len(self.stack) > i:
+                    self.pop_element()
+                break
+            if (is_nestable and other in reset_triggers) or \
+                    (not is_nestable and is_reset_nesting and other in BeautifulSoup.RESET_NESTING_TAGS):
+                # Close up to (but not including) the nesting reset trigger.
+                while len(self.stack) > i + 1:
+                    self.pop_element()
+                break
+
+    def pop_element(self):
+        """
+        Close the innermost open element and add its simplified node to the
+        contents of its parent.
+        """
+        element = self.stack.pop()
+        element.is_open = False
+        element.last_string = len(self.strings)
+        if element.name in BeautifulSoup.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace -= 1
+        if element is self.title_element:
+            self.title = u''.join(self.title_strings)
+        if not (element.ignored or self.finished):
+            element.node = self.pack(simplify_element(element))
+            self.stack[-1].contents.append(element.node)
+            if element is self.content_element:
+                self.finished = True
+
+    def flush_text(self):
+        """
+        Add the text collected since the previous tag to the open element.
+        """
+        if self.pending_text:
+            text = self.collapse_whitespace(u''.join(self.pending_text))
+            self.pending_text = []
+            if self.title_element is not None and self.title_element.is_open:
+                self.title_strings.append(text)
+            if not (self.stack[-1].ignored or self.finished):
+                self.strings.append(text)
+                self.stack[-1].contents.append(self.pack(Text(text=text)))
+
+    def pack(self, node):
+        """
+        Add a simplified parse tree node to the compact tree (if any). Returns
+        the view of the node in the compact tree or the node itself.
+        """
+        if self.tree is None:
+            return node
+        return self.tree.view(self.tree.add(node))
+
+    def collapse_whitespace(self, text):
+        """
+        Collapse text consisting only of whitespace to a single space or
+        newline (except inside preformatted text).
+        """
+        if not (self.preserve_whitespace or text.strip(u' \t\n\r\f')):
+            return u'\n' if u'\n' in text else u' '
+        return text
+
+class HTMLElement(object):
+
     """
-    Mark references to tags defined in the document.
+    HTML element parsed by ``StreamingTreeBuilder``. Supports the subset of
+    the BeautifulSoup ``Tag`` API that's used by the ``parse()`` methods of
+    the node types and by ``soupselect.matches()``, however the contents of
+    the element are simplified parse tree nodes.
     """
-    def recurse(node, parent):
-        if isinstance(node, CodeFragment) and node.text in tags:
-            return TagReference(node.text, [Text(text=node.text)], parent=node.parent)
-        if isinstance(node, SequenceNode):
-            new_contents = []
-            for child in node:
-                new_contents.append(recurse(child, node))
-            node.contents = new_contents
-        return node
-    return recurse(root, None)
 
-def find_references(root, url):
+    __slots__ = ('builder', 'name', 'attrs', 'parent', 'contents', 'ignored',
+                 'is_open', 'first_string', 'last_string', 'node')
+
+    def __init__(self, builder, name, attrs, parent):
+        self.builder = builder
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.contents = []
+        self.ignored = False
+        self.is_open = True
+        self.first_string = len(builder.strings)
+        self.last_string = None
+        self.node = None
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def has_key(self, key):
+        return key in self.attrs
+
+    def findAll(self, text=None):
+        """
+        Get the text in the element (only ``findAll(text=True)`` is supported).
+        """
+        return self.builder.strings[self.first_string:self.last_string]
+
+class SoupElement(object):
+
     """
-    Scan the document tree for hyper links. Each hyper link is given a unique
-    number so that it can be referenced inside the Vim help file. A new section
-    is appended to the tree which lists an overview of all references to hyper
-    links extracted from the HTML document.
+    Element of a BeautifulSoup parse tree whose contents have already been
+    simplified (see ``simplify_node()``). Supports the same subset of the
+    BeautifulSoup ``Tag`` API as ``HTMLElement``.
     """
-    # Mapping of hyper link targets to "Reference" objects.
-    by_target = {}
-    # Ordered list of "Reference" objects.
-    by_reference = []
-    logger.debug("Scanning parse tree for hyper links and other references ..")
-    for node in walk_tree(root, (HyperLink, Image)):
-        if isinstance(node, Image):
-            target = node.src
+
+    __slots__ = ('tag', 'name', 'contents')
+
+    def __init__(self, tag, contents):
+        self.tag = tag
+        self.name = tag.name
+        self.contents = contents
+
+    def get(self, key, default=None):
+        return self.tag.get(key, default)
+
+    def has_key(self, key):
+        return self.tag.has_key(key)
+
+    def findAll(self, text=None):
+        """
+        Get the text in the element (only ``findAll(text=True)`` is supported).
+        """
+        return self.tag.findAll(text=True)
+
+def looks_like_vim_tag(text):
+    """
+    Check whether the text of a code fragment looks like a reference to Vim's
+    documentation, like ``'tabstop'``, ``feedkeys()``, ``:help`` or ``<C-w>``.
+    Plain words and single characters are excluded because code fragments
+    like ``i`` or ``map`` are usually not meant as references to Vim's
+    documentation (even though Vim defines those tags).
+    """
+    return len(text) > 1 and not text.isalnum() and not text.isspace()
+
+def render_document(root, writer, **kw):
+    """
+    Render the simplified parse tree and feed the rendered output to the
+    given ``OutputWriter``. The top level nodes are rendered one at a time so
+    that the rendered text of the whole document is never kept in memory.
+    """
+    if isinstance(root, BlockLevelSequence):
+        writer.write(root.start_delimiter)
+        for node in root:
+            writer.write(join_blocks([node], **kw))
+        writer.write(root.end_delimiter)
+    else:
+        writer.write(root.render(**kw))
+
+def render_sections(root, writer, cache, **kw):
+    """
+    Render the simplified parse tree like ``render_document()`` but reuse the
+    rendered output of sections that haven't changed since a previous
+    conversion. The top level nodes are split into sections at level 1 and 2
+    headings (see ``split_sections()``) and the rendered output of each
+    section is stored in the given ``SectionCache`` under a hash of the parse
+    tree of the section. References and table of contents entries are part of
+    the hash, so sections are rendered again when the numbering of the
+    references or headings changes. Returns a tuple with the number of
+    sections and the number of sections that were reused.
+    """
+    if not isinstance(root, BlockLevelSequence):
+        render_document(root, writer, **kw)
+        return 0, 0
+    writer.write(root.start_delimiter)
+    sections = split_sections(root)
+    num_reused = 0
+    changed = False
+    for nodes in sections:
+        key = cache.key(fingerprint_section(nodes))
+        output = cache.get_output(key)
+        if output is None:
+            output = flatten_output([join_blocks([node], **kw) for node in nodes])
+            cache.put_output(key, output)
+            changed = True
         else:
-            target = node.target
-        if not target:
-            continue
-        if target == 'http://www.vim.org/':
-            # Don't add a reference to the Vim homepage in Vim help files.
-            continue
-        if target.startswith('http://vimdoc.sourceforge.net/htmldoc/'):
-            # Don't add a reference to the online Vim documentation.
-            continue
-        # Try to convert relative URLs into absolute URLs.
-        if url and not re.match(r'^\w+:', target):
-            target = urlparse.urljoin(url, target)
-        # Now try to convert absolute URLs into relative URLs... This does
-        # actually make sense, but it sure sounds stupid :-p. All it really
-        # does is normalize URLs to a common format.
-        relative_target = target
-        if url:
-            relative_target = os.path.relpath(target, url)
-        if relative_target.startswith('#'):
-            # Skip links to page anchors on the same page.
-            continue
-        # Exclude literal URLs from list of references.
-        if target.replace('mailto:', '') == node.render(indent=0):
-            continue
-        # Make sure we don't duplicate references.
-        if target in by_target:
-            r = by_target[target]
+            num_reused += 1
+        writer.write(output)
+    writer.write(root.end_delimiter)
+    if changed:
+        try:
+            cache.evict()
+        except OSError, e:
+            logger.warning("Failed to evict old entries from section cache in %s! (%s)", cache.directory, e)
+    return len(sections), num_reused
+
+def render_parallel(root, writer, workers, **kw):
+    """
+    Render the simplified parse tree like ``render_document()`` in a pool of
+    worker processes. The top level nodes are split into sections (see
+    ``split_sections()``) and the workers render whole sections. The tree
+    (which includes the tags, references and table of contents) is passed to
+    each worker once, as an argument of the pool initializer (worker
+    processes started by forking inherit it, otherwise it's pickled), so only
+    the rendered output of each section is sent back. The output is fed to
+    the ``OutputWriter`` in document order, so the delimiters between
+    sections are merged like they are when the document is rendered in a
+    single process.
+
+    Starting the pool and sending the output back only pays off when the
+    workers run at the same time, so the number of workers is limited to the
+    number of CPUs and to one worker per ``PARALLEL_MIN_SECTIONS`` sections.
+    When that leaves a single worker the document is rendered by
+    ``render_document()`` instead. Returns a tuple with the number of
+    sections and the number of worker processes (1 when the document was
+    rendered serially).
+    """
+    if not isinstance(root, BlockLevelSequence):
+        render_document(root, writer, **kw)
+        return 0, 1
+    sections = split_sections(root)
+    workers = min(workers, multiprocessing.cpu_count(), len(sections) / PARALLEL_MIN_SECTIONS)
+    if workers < 2:
+        logger.debug("Rendering %i section(s) serially (not enough CPUs or sections) ..", len(sections))
+        render_document(root, writer, **kw)
+        return len(sections), 1
+    # Make sure the index is up to date before it's copied to the workers.
+    kw['index'].update()
+    writer.write(root.start_delimiter)
+    pool = multiprocessing.Pool(workers, init_render_worker, (sections, kw))
+    try:
+        chunk_size = max(1, len(sections) / (workers * 4))
+        for output in pool.imap(render_section, xrange(len(sections)), chunk_size):
+            writer.write(output)
+    finally:
+        pool.terminate()
+        pool.join()
+    writer.write(root.end_delimiter)
+    return len(sections), workers
+
+# The sections and render context of the worker processes started by
+# render_parallel().
+render_state = {}
+
+def init_render_worker(sections, kw):
+    """
+    Initialize a worker process of ``render_parallel()``.
+    """
+    render_state.update(sections=sections, kw=kw)
+
+def render_section(number):
+    """
+    Render a section in a worker process of ``render_parallel()``. Returns
+    the rendered output as a flat list of strings and ``OutputDelimiter``
+    objects in which adjacent strings are joined (the ``OutputWriter``
+    writes adjacent strings as is), so that less data is sent back.
+    """
+    kw = render_state['kw']
+    output = []
+    text = []
+    for value in flatten_output([join_blocks([node], **kw) for node in render_state['sections'][number]]):
+        if isinstance(value, OutputDelimiter):
+            if text:
+                output.append(u''.join(text))
+                text = []
+            output.append(value)
         else:
-            number = len(by_reference) + 1
-            logger.debug("Extracting reference #%i to %s ..", number, target)
-            r = Reference(number=number, target=target)
-            by_reference.append(r)
-            by_target[target] = r
-        node.reference = r
-    logger.debug("Found %i references.", len(by_reference))
-    if by_reference:
-        logger.debug("Generating 'References' section ..")
-        root.contents.append(Heading(level=1, contents=[Text(text="References")]))
-        root.contents.extend(by_reference)
+            text.append(value)
+    if text:
+        output.append(u''.join(text))
+    return output
 
-def generate_table_of_contents(root):
+def split_sections(root):
     """
-    Generate a table of contents for the Vim help file based on the headings
-    defined in the Markdown or HTML document provided by the user.
+    Split the top level nodes of the simplified parse tree into a list of
+    sections (lists of nodes), each starting at a level 1 or 2 heading (except
+    the first section which contains the nodes before the first heading).
     """
-    entries = []
-    counters = []
-    for heading in walk_tree(root, Heading):
-        logger.debug("Stack of counters before reset: %s", counters)
-        # Forget no longer relevant counters.
-        counters = counters[:heading.level]
-        logger.debug("Stack of counters after reset: %s", counters)
-        # Make the stack of counters big enough.
-        while len(counters) < heading.level:
-            counters.append(1)
-        logger.debug("Stack of counters after padding: %s", counters)
-        entries.append(TableOfContentsEntry(
-            indent=heading.level,
-            number=counters[heading.level - 1],
-            contents=copy(heading.contents),
-            tag=getattr(heading, 'tag', None)))
-        counters[heading.level - 1] += 1
-    for i, entry in enumerate(entries, start=1):
-        logger.debug("Table of contents entry %i: %s", i, entry)
-    root.contents.insert(0, Heading(level=1, contents=[Text(text="Contents")]))
-    root.contents.insert(1, BlockLevelSequence(contents=entries))
-
-def copy(node):
-    """
-    Copy a subtree, breaking references to the old position in the tree.
-    """
-    if isinstance(node, list):
-        return map(copy, node)
-    elif isinstance(node, Node):
-        attributes = {}
-        for name in dir(node):
-            value = getattr(node, name)
-            # Ignore private attributes.
-            if name.startswith('_'):
-                logger.debug("Ignoring private attribute: %s", name)
-                continue
-            # Ignore methods reported by 'dir'.
-            if isinstance(value, types.MethodType):
-                logger.debug("Ignoring non-attribute: %s", name)
-                continue
-            # Copy only child nodes, never parent nodes.
-            if 'parent' in name:
-                logger.debug("Ignoring parent node attribute: %s", name)
-                continue
-            # Copy attribute value.
-            logger.debug("Copying attribute %s ..", name)
-            attributes[name] = copy(getattr(node, name))
-        # Instantiate the new object.
-        return node.__class__(**attributes)
-    else:
-        return node
+    sections = []
+    for node in root:
+        if not sections or (isinstance(node, Heading) and node.level <= 2):
+            sections.append([])
+        sections[-1].append(node)
+    return sections
 
-def prune_empty_blocks(root):
+# Node attributes that affect the rendered text of a section.
+SECTION_ATTRIBUTES = ('level', 'ordered', 'header', 'text', 'tag', 'target', 'src', 'alt', 'number', 'indent')
+
+def fingerprint_section(nodes):
     """
-    Prune empty block level nodes from the tree.
+    Compute a hash of the parse tree of a section: The types and attributes
+    of the nodes (including the numbers of references and the contents of the
+    headings that table of contents entries refer to) and the structure of
+    the tree.
     """
-    def recurse(node):
-        if isinstance(node, SequenceNode):
-            filtered_children = []
-            for child in node:
-                recurse(child)
-                if child:
-                    filtered_children.append(child)
-            node.contents = filtered_children
-    recurse(root)
+    context = hashlib.sha1()
+    pending = list(reversed(nodes))
+    while pending:
+        node = pending.pop()
+        if node is None:
+            # End of the contents of a node.
+            context.update(')')
+            continue
+        values = [type(node).__name__]
+        for name in SECTION_ATTRIBUTES:
+            values.append(getattr(node, name, None))
+        reference = getattr(node, 'reference', None)
+        values.append(reference.number if reference is not None else None)
+        context.update(repr(values))
+        if isinstance(node, TableOfContentsEntry):
+            children = list(node.heading.contents)
+        else:
+            children = list(getattr(node, 'contents', []))
+        context.update('(')
+        pending.append(None)
+        pending.extend(reversed(children))
+    return context.hexdigest()
 
-def make_parents_explicit(root):
+def flatten_output(value):
     """
-    Add links from child nodes to parent nodes.
+    Flatten the (nested lists of) strings and ``OutputDelimiter`` objects
+    returned by the render methods into a single list.
     """
-    def recurse(node, parent):
-        if isinstance(node, Node):
-            node.parent = parent
-            for child in getattr(node, 'contents', []):
-                recurse(child, node)
-    recurse(root, None)
+    output = []
+    pending = [value]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (OutputDelimiter, basestring)):
+            output.append(value)
+        else:
+            pending.extend(reversed(value))
+    return output
 
 def walk_tree(root, *node_types):
     """
@@ -562,14 +1809,213 @@ def walk_tree(root, *node_types):
     order of English text).
     """
     ordered_nodes = []
-    def recurse(node):
-        if not (node_types and not isinstance(node, node_types)):
-            ordered_nodes.append(node)
-        for child in getattr(node, 'contents', []):
-            recurse(child)
-    recurse(root)
+    # The tree is walked using a stack of iterators over the children of the
+    # nodes on the current path (instead of recursion).
+    stack = [iter((root,))]
+    while stack:
+        for node in stack[-1]:
+            if not (node_types and not isinstance(node, node_types)):
+                ordered_nodes.append(node)
+            if isinstance(node, SequenceNode):
+                stack.append(iter(node))
+                break
+        else:
+            stack.pop()
     return ordered_nodes
 
+def find_nodes(root, node_types, index=None):
+    """
+    Return a list of the nodes of the given type(s) in the subtree rooted at
+    the given node, ordered by the original document order. Uses the node
+    index when the caller has one, otherwise falls back to ``walk_tree()``.
+    """
+    if index is not None:
+        return index.find(node_types, root)
+    return walk_tree(root, node_types)
+
+class NodeIndex(object):
+
+    """
+    Index of the nodes in a simplified parse tree, grouped by node type.
+
+    Several passes over the simplified parse tree (and several render methods)
+    need to find the nodes of a given type, either in the whole document or
+    in a specific subtree. Instead of walking the (sub)tree for every query
+    the tree is walked once to record the document order position, the
+    parent and the number of descendants of every node. Queries are then
+    answered using binary search on the positions of each node type.
+
+    Passes that change the structure of the tree call ``invalidate()``
+    afterwards; the index is rebuilt on the next query.
+
+    The index also caches the rendered text of the inline contents of nodes
+    (see ``join_contents()``), so that e.g. the text of a hyper link that
+    ``FindReferences`` rendered isn't rendered again with the paragraph
+    that contains it. Passes that change the rendered text of a node call
+    ``forget()`` to discard the cached text of the node and its ancestors.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.rendered = {}
+        self.invalidate()
+
+    @staticmethod
+    def create(root):
+        """
+        Create the index of a simplified parse tree (a ``CompactNodeIndex``
+        when the tree is stored in a ``CompactTree``).
+        """
+        if isinstance(root, NodeView):
+            return CompactNodeIndex(root)
+        return NodeIndex(root)
+
+    def invalidate(self):
+        """
+        Mark the index as out of date (it will be rebuilt on the next query).
+        """
+        self.stale = True
+
+    def update(self):
+        """
+        Rebuild the index if the tree has changed since it was last built.
+        """
+        if self.stale:
+            logger.debug("Building index of parse tree ..")
+            self.nodes = []
+            self.parents = array.array('i')
+            self.sizes = array.array('i')
+            self.positions = {}
+            self.by_type = collections.defaultdict(list)
+            self.scan(self.root)
+            self.stale = False
+            logger.debug("Indexed %i nodes of %i types.", len(self.nodes), len(self.by_type))
+
+    def scan(self, root):
+        """
+        Add a node and its descendants to the index. The tree is walked like
+        ``walk_tree()`` does it (without recursion), the number of descendants
+        of a node is known when the iterator over its children is exhausted.
+        """
+        stack = [iter((root,))]
+        # The positions of the nodes whose children are iterated.
+        positions = [-1]
+        while stack:
+            for node in stack[-1]:
+                position = len(self.nodes)
+                self.nodes.append(node)
+                self.parents.append(positions[-1])
+                self.sizes.append(0)
+                self.positions[node] = position
+                self.by_type[type(node)].append(position)
+                if isinstance(node, SequenceNode):
+                    stack.append(iter(node))
+                    positions.append(position)
+                    break
+            else:
+                stack.pop()
+                position = positions.pop()
+                if position >= 0:
+                    self.sizes[position] = len(self.nodes) - position - 1
+
+    def position(self, node):
+        """
+        Get the document order position of a node in the index (None for
+        nodes that aren't part of the tree, e.g. created during rendering).
+        """
+        return self.positions.get(node)
+
+    def node(self, position):
+        """
+        Get the node at the given document order position.
+        """
+        return self.nodes[position]
+
+    def key(self, node):
+        """
+        Get the key of a node in the cache of rendered text.
+        """
+        return node
+
+    def find(self, node_types, root=None):
+        """
+        Return a list of the nodes of the given type(s) ordered by document
+        order. If a root node is given only that node and its descendants
+        are considered (just like ``walk_tree()``).
+        """
+        self.update()
+        if root is None:
+            first, last = 0, len(self.nodes)
+        else:
+            first = self.position(root)
+            if first is None:
+                # Nodes that are not part of the tree (e.g. created during
+                # rendering) aren't indexed.
+                return walk_tree(root, node_types)
+            last = first + self.sizes[first] + 1
+        matching_types = 0
+        positions = []
+        for node_type, candidates in self.by_type.iteritems():
+            if issubclass(node_type, node_types):
+                matching_types += 1
+                positions.extend(candidates[bisect.bisect_left(candidates, first):
+                                            bisect.bisect_left(candidates, last)])
+        if matching_types > 1:
+            positions.sort()
+        return [self.node(p) for p in positions]
+
+    def parent(self, node):
+        """
+        Get the parent of a node in the tree (None for the root node).
+        """
+        self.update()
+        position = self.parents[self.position(node)]
+        return self.node(position) if position >= 0 else None
+
+    def count_descendants(self, node):
+        """
+        Get the number of descendants of a node in the tree.
+        """
+        self.update()
+        return self.sizes[self.position(node)]
+
+    def cached_text(self, node, **kw):
+        """
+        Get the cached text of the contents of a node rendered with the given
+        keyword arguments (None if it hasn't been cached).
+        """
+        texts = self.rendered.get(self.key(node))
+        if texts:
+            return texts.get(self.render_context(kw))
+
+    def cache_text(self, node, text, **kw):
+        """
+        Cache the text of the contents of a node rendered with the given
+        keyword arguments.
+        """
+        self.rendered.setdefault(self.key(node), {})[self.render_context(kw)] = text
+
+    def forget(self, node, ancestors=True):
+        """
+        Forget the cached text of a node and (unless ``ancestors`` is False)
+        the cached text of its ancestors.
+        """
+        if ancestors:
+            self.update()
+        self.rendered.pop(self.key(node), None)
+        position = self.position(node) if ancestors else None
+        while position is not None and self.parents[position] >= 0:
+            position = self.parents[position]
+            self.rendered.pop(self.key(self.node(position)), None)
+
+    @staticmethod
+    def render_context(kw):
+        """
+        Get the keyword arguments that affect the rendered text of inline
+        contents as a tuple (the indentation and the heading context).
+        """
+        return kw['indent'], kw.get('in_heading', False)
+
 # Objects to encapsulate output text with a bit of state.
 
 class OutputDelimiter(object):
@@ -580,7 +2026,7 @@ class OutputDelimiter(object):
     text from delimiters).
 
     Note that most of the actual logic for handling of output delimiters is
-    currently contained in the function ``deduplicate_delimiters()``.
+    currently contained in the class ``OutputWriter``.
     """
 
     def __init__(self, string):
@@ -592,6 +2038,93 @@ class OutputDelimiter(object):
     def __repr__(self):
         return "OutputDelimiter(string=%r)" % self.string
 
+class OutputWriter(object):
+
+    """
+    Output sink for rendered Vim help text. Receives text and (nested lists
+    of) ``OutputDelimiter`` objects while the document is being rendered and
+    writes them to a file-like object, deduplicating redundant block
+    delimiters on the fly:
+
+    - When two delimiters are adjacent the whitespace delimiter is dropped in
+      favor of the other one, otherwise the shorter delimiter is dropped.
+      Adjacent non-whitespace delimiters of equal length are both kept.
+    - Whitespace delimiters at the start and end of the document are stripped.
+
+    Only the run of delimiters following the most recent text is buffered,
+    everything else is written to the stream immediately.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.delimiters = []
+        self.started = False
+
+    def write(self, value):
+        """
+        Write rendered output (a string, an ``OutputDelimiter`` or a
+        (nested) list of those) to the stream.
+        """
+        pending = [value]
+        while pending:
+            value = pending.pop()
+            if isinstance(value, OutputDelimiter):
+                self.add_delimiter(value)
+            elif isinstance(value, basestring):
+                self.flush()
+                self.stream.write(unicode(value))
+            else:
+                pending.extend(reversed(value))
+
+    def add_delimiter(self, delimiter):
+        """
+        Merge a block delimiter into the run of pending delimiters.
+        """
+        if self.delimiters:
+            previous = self.delimiters[-1].string
+            current = delimiter.string
+            if previous.isspace() and not current.isspace():
+                self.delimiters[-1] = delimiter
+            elif current.isspace() and not previous.isspace():
+                pass
+            elif len(previous) < len(current):
+                self.delimiters[-1] = delimiter
+            elif len(previous) > len(current):
+                pass
+            elif previous.isspace():
+                self.delimiters[-1] = delimiter
+            else:
+                self.delimiters.append(delimiter)
+        else:
+            self.delimiters.append(delimiter)
+
+    def flush(self):
+        """
+        Write the pending delimiters to the stream (stripping leading
+        whitespace delimiters at the start of the document).
+        """
+        if not self.started:
+            self.strip_leading_delimiters()
+            self.started = True
+        for delimiter in self.delimiters:
+            self.stream.write(unicode(delimiter))
+        self.delimiters = []
+
+    def close(self):
+        """
+        Finish the output, stripping whitespace delimiters at the end of the
+        document.
+        """
+        if not self.started:
+            self.strip_leading_delimiters()
+        while self.delimiters and self.delimiters[-1].string.isspace():
+            self.delimiters.pop(-1)
+        self.flush()
+
+    def strip_leading_delimiters(self):
+        while self.delimiters and self.delimiters[0].string.isspace():
+            self.delimiters.pop(0)
+
 # Decorator for abstract syntax tree nodes.
 
 def html_element(*element_names):
@@ -634,15 +2167,26 @@ class Node(object):
             contents = "\n" + ",\n".join(nodes)
         return "%s(%s)" % (self.__class__.__name__, contents)
 
-    @property
-    def parents(self):
+    def in_heading(self, **kw):
         """
-        Generator that yields all parents of a node.
+        Check whether the node is being rendered as part of a heading. The
+        ``in_heading`` keyword argument is passed down by the renderers
+        (``render_document()`` starts with False and ``Heading.render()``
+        sets it to True), the table of contents uses it to render the text of
+        headings as regular text. Nodes rendered without it (e.g. by
+        ``repr()``) aren't part of a heading.
         """
-        node = self
-        while node:
-            node = node.parent
-            yield node
+        return kw.get('in_heading', False)
+
+    def layout(self, text, **kw):
+        """
+        Add the rendered node to an ``InlineText`` (see ``join_inline()``).
+        Inline nodes that contain other inline nodes override this with a
+        generator that adds the text of their children directly, by yielding
+        the child nodes whose text should be nested (see
+        ``InlineText.layout()``).
+        """
+        text.append(self.render(**kw))
 
 class BlockLevelNode(Node):
     """
@@ -678,9 +2222,25 @@ class SequenceNode(Node):
     def __nonzero__(self):
         """
         Make it possible to determine whether a subtree contains
-        only whitespace.
+        only whitespace. Once ``PruneEmptyBlocks`` has cached the answer
+        on the node it's returned as is, otherwise nested sequences are
+        searched using an explicit stack (instead of recursion) unless they
+        define their own rules.
         """
-        return any(bool(c) for c in self)
+        empty = getattr(self, 'empty', None)
+        if empty is not None:
+            return not empty
+        stack = [iter(self)]
+        while stack:
+            for child in stack[-1]:
+                if has_default_emptiness(child) and getattr(child, 'empty', None) is None:
+                    stack.append(iter(child))
+                    break
+                elif child:
+                    return True
+            else:
+                stack.pop()
+        return False
 
     def __len__(self):
         """
@@ -703,7 +2263,25 @@ class BlockLevelSequence(BlockLevelNode, SequenceNode):
     """
 
     def render(self, **kw):
-        text = join_blocks(self.contents, **kw)
+        # Nested sequences (e.g. from deeply nested <div> elements) are
+        # rendered using an explicit stack instead of recursion. Each nested
+        # sequence still renders as [start_delimiter, contents, end_delimiter]
+        # with its contents in a list of their own, because the renderers of
+        # the enclosing nodes look at the first element of their output (e.g.
+        # ListItem.render() strips leading delimiters).
+        text = []
+        stack = [(iter(self.contents), text)]
+        while stack:
+            children, output = stack[-1]
+            for node in children:
+                if isinstance(node, BlockLevelSequence):
+                    contents = []
+                    output.extend([node.start_delimiter, contents, node.end_delimiter])
+                    stack.append((iter(node.contents), contents))
+                    break
+                output.extend(join_blocks([node], **kw))
+            else:
+                stack.pop()
         return [self.start_delimiter, text, self.end_delimiter]
 
 @html_element('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
@@ -721,33 +2299,39 @@ class Heading(BlockLevelNode, SequenceNode):
         return Heading(level=int(html_node.name[1]),
                        contents=simplify_children(html_node))
 
-    def tag_heading(self, existing_tags, prefix):
+    def tag_heading(self, existing_tags, prefix, index=None):
         # Look for a <code> element (indicating a source code
         # entity) whose text has not yet been used as a tag.
-        matches = walk_tree(self, CodeFragment)
-        logger.debug("Found %i code fragments inside heading: %s", len(matches), matches)
+        matches = find_nodes(self, CodeFragment, index)
+        if tracing.enabled:
+            tracer.debug("Found %i code fragments inside heading: %s", len(matches), matches)
         for node in matches:
             tag = create_tag(node.text, prefix=prefix, is_code=True)
-            logger.debug("Checking if %r (from %r) can be used as a tag ..", tag, node.text)
+            if tracing.enabled:
+                tracer.debug("Checking if %r (from %r) can be used as a tag ..", tag, node.text)
             if tag not in existing_tags:
                 # Found a usable tag.
                 self.tag = tag
                 return tag
-        # Fall back to a tag generated from the heading's text.
-        text = join_inline(self.contents, indent=0)
+        # Fall back to a tag generated from the heading's text. The parents of
+        # nodes aren't known yet so they don't know they're in a heading (by
+        # saying so explicitly the text is cached for the table of contents).
+        text = join_contents(self, self.contents, indent=0, in_heading=False, index=index)
         tag = create_tag(text, prefix=prefix, is_code=False)
-        logger.debug("Checking if %r (from %r) can be used as a tag ..", tag, text)
+        if tracing.enabled:
+            tracer.debug("Checking if %r (from %r) can be used as a tag ..", tag, text)
         if tag not in existing_tags:
             self.tag = tag
             return tag
 
     def render(self, **kw):
-        logger.debug("Rendering heading: %s", self)
+        if tracing.enabled:
+            tracer.debug("Rendering heading: %s", self)
         # We start with a line containing the marker symbol for headings,
         # repeated on the full line. The symbol depends on the level.
         lines = [('=' if self.level == 1 else '-') * TEXT_WIDTH]
         # Render the heading's text.
-        text = join_inline(self.contents, **kw)
+        text = join_contents(self, self.contents, **dict(kw, in_heading=True))
         suffix = ' ~'
         # Add a section tag?
         if hasattr(self, 'tag'):
@@ -784,7 +2368,7 @@ class Paragraph(BlockLevelNode, SequenceNode):
     def render(self, **kw):
         # If the paragraph contains only an image (possible wrapped in another
         # element) the paragraph is indented by a minimum of two spaces.
-        if len(self.contents) == 1 and len(walk_tree(self, Image)) == 1:
+        if len(self.contents) == 1 and len(find_nodes(self, Image, kw.get('index'))) == 1:
             kw['indent'] = max(2, kw['indent'])
         return [self.start_delimiter, join_inline(self.contents, **kw), self.end_delimiter]
 
@@ -847,13 +2431,14 @@ class List(BlockLevelNode, SequenceNode):
         num_lines = 0
         for node in self.contents:
             if isinstance(node, ListItem):
-                text = node.render(number=len(items) + 1, **kw)
+                text = node.render(number=len(items) + 1, ordered=self.ordered, **kw)
                 items.append(text)
                 for x in text:
                     if isinstance(x, basestring):
                         num_lines += x.count('\n')
                 num_lines += 1
-        logger.debug("num_lines=%i, #items=%i, ratio=%.2f", num_lines, len(items), num_lines / float(len(items)))
+        if tracing.enabled:
+            tracer.debug("num_lines=%i, #items=%i, ratio=%.2f", num_lines, len(items), num_lines / float(len(items)))
         if (num_lines / float(len(items))) > 1.5:
             delimiter = OutputDelimiter('\n\n')
         # Second pass: Combine the delimiters & rendered child nodes.
@@ -873,11 +2458,14 @@ class ListItem(BlockLevelNode, SequenceNode):
     Maps to the HTML element ``<li>``.
     """
 
-    def render(self, number, **kw):
+    def render(self, number, ordered=None, **kw):
         # Get the original prefix (indent).
         prefix = ' ' * kw['indent']
-        # Append the list item bullet.
-        if self.parent.ordered:
+        # Append the list item bullet (List.render() tells us whether the
+        # list is ordered, otherwise we ask the parent).
+        if ordered is None:
+            ordered = getattr(self.parent, 'ordered', False)
+        if ordered:
             prefix += '%i. ' % number
         else:
             prefix += '- '
@@ -902,18 +2490,206 @@ class ListItem(BlockLevelNode, SequenceNode):
         # they will be chosen *after* all of the list items have been rendered.
         return [prefix] + text
 
-# TODO Parse and render tabular data.
-#@html_element('table')
+@html_element('table')
+class Table(BlockLevelNode, SequenceNode):
+
+    """
+    Block level node to represent tabular data.
+    Maps to the HTML element ``<table>``.
+
+    The rows are rendered as aligned columns of text. The text of every cell
+    is rendered (as a single line) and measured once, after which the width
+    of each column is known and the rows can be laid out. When the columns
+    don't fit in ``TEXT_WIDTH`` the rows are rendered as a list instead.
+    Other contents of the table (like a ``<caption>``) are rendered as text
+    above the rows.
+
+    Tables can be nested in the cells of other tables. Rendering a cell
+    renders the tables inside it, so to avoid one level of recursion per
+    level of nesting the outermost table renders the lines of all of the
+    cells inside it up front, innermost cells first (see
+    ``render_cell_lines()``), and the nested tables reuse those lines.
+    """
+
+    @staticmethod
+    def parse(html_node):
+        # Look for the rows inside <thead>, <tbody> and <tfoot> elements
+        # (which are simplified to sequences) and drop the whitespace
+        # between the rows.
+        contents = []
+        pending = list(reversed(list(simplify_children(html_node))))
+        while pending:
+            node = pending.pop()
+            if isinstance(node, (BlockLevelSequence, InlineSequence)) and any(isinstance(n, TableRow) for n in node):
+                pending.extend(reversed(list(node)))
+            elif isinstance(node, TableRow) or not is_whitespace(node):
+                contents.append(node)
+        return Table(contents=contents)
+
+    def render(self, **kw):
+        if 'cell_lines' not in kw:
+            kw = dict(kw, cell_lines=self.render_cell_lines(**kw))
+        rows = [n for n in self if isinstance(n, TableRow)]
+        other = [n for n in self if not isinstance(n, TableRow)]
+        output = [self.start_delimiter]
+        if other:
+            output.append(join_smart(other, **kw))
+        if rows:
+            if other:
+                output.append(OutputDelimiter('\n'))
+            output.extend(self.render_rows(rows, **kw))
+        output.append(self.end_delimiter)
+        return output
+
+    def render_cell_lines(self, **kw):
+        """
+        Render the cells in the table (including the cells of nested tables)
+        as single lines. Returns a dictionary that maps the cells to their
+        lines. The cells are rendered in reverse document order, so the cells
+        of a nested table are rendered before the cell that contains the
+        table, which then renders the table using the lines that are already
+        in the dictionary.
+        """
+        lines = {}
+        kw = dict(kw, cell_lines=lines)
+        for cell in reversed(walk_tree(self, TableCell)):
+            lines[cell] = cell.render_line(**kw)
+        return lines
+
+    def render_rows(self, rows, **kw):
+        """
+        Render the rows of the table (as columns or as a list).
+        """
+        # Render and measure all of the cells.
+        table = []
+        widths = []
+        for row in rows:
+            cells = row.cells()
+            texts = []
+            for i, cell in enumerate(cells):
+                text = kw['cell_lines'][cell]
+                width = len(text)
+                if i == len(widths):
+                    widths.append(width)
+                elif width > widths[i]:
+                    widths[i] = width
+                texts.append((text, width))
+            table.append((texts, bool(cells) and all(c.header for c in cells)))
+        has_header = any(is_header for texts, is_header in table)
+        total_width = kw['indent'] + sum(widths) + 2 * max(0, len(widths) - 1) + (2 if has_header else 0)
+        if total_width <= TEXT_WIDTH:
+            return [self.render_columns(table, widths, **kw)]
+        else:
+            return self.render_list(table, **kw)
+
+    def render_columns(self, table, widths, **kw):
+        """
+        Render the (measured) cells as aligned columns. Header rows are
+        marked with a trailing ``~`` (like headings).
+        """
+        prefix = ' ' * kw['indent']
+        lines = []
+        for texts, is_header in table:
+            cells = []
+            for i, (text, width) in enumerate(texts):
+                if i < len(texts) - 1:
+                    text += ' ' * (widths[i] - width)
+                cells.append(text)
+            line = "  ".join(cells).rstrip()
+            if line:
+                lines.append(prefix + line + (' ~' if is_header else ''))
+        return "\n".join(lines)
+
+    def render_list(self, table, **kw):
+        """
+        Render the (measured) cells as a list with an item for each row and
+        a line for each cell. The cells are labeled with the text of the
+        header cells above them (when the first row is a header row).
+        """
+        prefix = ' ' * kw['indent']
+        labels = []
+        if table and table[0][1]:
+            labels = [text for text, width in table[0][0]]
+            table = table[1:]
+        items = []
+        for texts, is_header in table:
+            lines = []
+            for i, (text, width) in enumerate(texts):
+                if text:
+                    words = text.split()
+                    if i < len(labels) and labels[i]:
+                        words.insert(0, labels[i] + ':')
+                    lines.extend(line_breaker.wrap(words, TEXT_WIDTH, prefix + '  '))
+            if lines:
+                lines[0] = prefix + '- ' + lines[0][len(prefix) + 2:]
+                items.append("\n".join(lines))
+        # Separate the items by empty lines unless every item fits on one line.
+        if any('\n' in item for item in items):
+            delimiter = OutputDelimiter('\n\n')
+        else:
+            delimiter = OutputDelimiter('\n')
+        output = []
+        for i, item in enumerate(items):
+            if i > 0:
+                output.append(delimiter)
+            output.append(item)
+        return output
+
+@html_element('tr')
+class TableRow(BlockLevelNode, SequenceNode):
+
+    """
+    Block level node to represent a row of tabular data.
+    Maps to the HTML element ``<tr>``.
+    """
+
+    @staticmethod
+    def parse(html_node):
+        return TableRow(contents=[n for n in simplify_children(html_node) if isinstance(n, TableCell)])
+
+    def cells(self):
+        """
+        Get the cells in the row.
+        """
+        return [n for n in self if isinstance(n, TableCell)]
+
+    def render(self, **kw):
+        # Rows outside of tables are rendered as a table with a single row.
+        return Table(contents=[self]).render(**kw)
+
+@html_element('td', 'th')
+class TableCell(BlockLevelNode, SequenceNode):
+
+    """
+    Block level node to represent a cell of tabular data.
+    Maps to the HTML elements ``<td>`` and ``<th>``.
+    """
+
+    @staticmethod
+    def parse(html_node):
+        return TableCell(header=(html_node.name == 'th'),
+                         contents=simplify_children(html_node))
 
-class Table(BlockLevelNode, SequenceNode):
+    def __nonzero__(self):
+        # Empty cells are significant (they keep the other cells in their column).
+        return True
 
-    """
-    Block level node to represent tabular data.
-    Maps to the HTML element ``<table>``.
-    """
+    def render_line(self, **kw):
+        """
+        Render the contents of the cell as a single line of text.
+        """
+        kw = dict(kw, indent=0)
+        if is_block_level(self.contents):
+            output = flatten_output(join_blocks(self.contents, **kw))
+            return compact(" ".join(s for s in output if isinstance(s, basestring)))
+        text = InlineText()
+        text.layout(self, **kw)
+        text.strip_glue()
+        return " ".join(text.words())
 
     def render(self, **kw):
-        return ''
+        # Cells outside of rows are rendered as regular text.
+        return [self.start_delimiter, join_smart(self.contents, **kw), self.end_delimiter]
 
 class Reference(BlockLevelNode):
 
@@ -931,17 +2707,25 @@ class Reference(BlockLevelNode):
         text = "[%i] %s" % (self.number, self.target)
         return [self.start_delimiter, text, self.end_delimiter]
 
-class TableOfContentsEntry(BlockLevelNode, SequenceNode):
+class TableOfContentsEntry(BlockLevelNode):
 
     """
     Block level node to represent a line in the table of contents.
+
+    The entry refers to the inline contents of its heading instead of owning
+    a copy of them. The contents are rendered with ``in_heading=False`` to
+    get the same text as a separate copy of the contents outside of the
+    heading would have.
     """
 
     start_delimiter = OutputDelimiter('\n')
     end_delimiter = OutputDelimiter('\n')
 
     def __repr__(self):
-        return "TableOfContentsEntry(indent=%i, number=%i, contents=%r)" % (self.indent, self.number, self.contents)
+        return "TableOfContentsEntry(indent=%i, number=%i, contents=%r)" % (self.indent, self.number, self.heading.contents)
+
+    def __nonzero__(self):
+        return bool(self.heading)
 
     def render(self, **kw):
         text = ''
@@ -950,15 +2734,17 @@ class TableOfContentsEntry(BlockLevelNode, SequenceNode):
         # Render the counter.
         text += "%i. " % self.number
         # Render the text.
-        text += join_inline(self.contents, indent=0)
+        text += join_contents(self.heading, self.heading.contents, **dict(kw, indent=0, in_heading=False))
         if self.tag:
             # Don't bother including redundant references.
-            for node in walk_tree(self, TagReference):
+            for node in find_nodes(self.heading, TagReference, kw.get('index')):
                 if node.tag == self.tag:
-                    logger.debug("Table of contents entry contains literal reference to tag ..")
+                    if tracing.enabled:
+                        tracer.debug("Table of contents entry contains literal reference to tag ..")
                     break
             else:
-                logger.debug("Table of contents entry doesn't have literal reference to tag; adding it ..")
+                if tracing.enabled:
+                    tracer.debug("Table of contents entry doesn't have literal reference to tag; adding it ..")
                 tag = "|%s|" % self.tag
                 # Render the padding.
                 padding = max(1, TEXT_WIDTH - len(text) - len(tag))
@@ -974,7 +2760,10 @@ class InlineSequence(InlineNode, SequenceNode):
     """
 
     def render(self, **kw):
-        return join_inline(self.contents, **kw)
+        return join_contents(self, self.contents, **kw)
+
+    def layout(self, text, **kw):
+        yield self.contents
 
 @html_element('img')
 class Image(InlineNode):
@@ -1013,17 +2802,20 @@ class TagReference(InlineNode, SequenceNode):
         return "TagReference(tag=%r, contents=%r)" % (self.tag, self.contents)
 
     def render(self, **kw):
-        logger.debug("About to render: %r", self)
-        text = join_inline(self.contents, **kw)
-        parents_which_are_headings = [p for p in self.parents if isinstance(p, Heading)]
-        if parents_which_are_headings:
-            logger.debug("Omitting tag reference inside heading %s (not valid) ..", parents_which_are_headings[0])
+        if tracing.enabled:
+            tracer.debug("About to render: %r", self)
+        text = join_contents(self, self.contents, **kw)
+        if self.in_heading(**kw):
+            if tracing.enabled:
+                tracer.debug("Omitting tag reference inside heading (not valid) ..")
             return text
         elif text.find(self.tag) >= 0:
-            logger.debug("Tag reference contains literal tag name, replacing ..")
+            if tracing.enabled:
+                tracer.debug("Tag reference contains literal tag name, replacing ..")
             return text.replace(self.tag, "|%s|" % self.tag)
         else:
-            logger.debug("Tag reference doesn't contain tag name, appending ..")
+            if tracing.enabled:
+                tracer.debug("Tag reference doesn't contain tag name, appending ..")
             return "%s (see |%s|)" % (text, self.tag)
 
 @html_element('a')
@@ -1047,24 +2839,40 @@ class HyperLink(InlineNode, SequenceNode):
         return HyperLink(target=target, contents=contents)
 
     def __repr__(self):
-        text = self.render(indent=0)
+        text = self.render(indent=0, in_heading=False)
         return "HyperLink(text=%r, target=%r, reference=%r)" % (text, self.target, getattr(self, 'reference', None))
 
     def render(self, **kw):
-        images = walk_tree(self, Image)
-        if len(self.contents) == 1 and len(images) == 1:
-            # If the hyper link contains a single child node which is
-            # (or contains) an image, we add a reference for the hyper
-            # link but not the image.
-            raw_text = "Image: " + images[0].alt
-            text = join_inline([Text(text=raw_text)], **kw)
-        else:
-            text = join_inline(self.contents, **kw)
+        text = join_contents(self, self.text_nodes(**kw), **kw)
         # Add references as needed.
         if hasattr(self, 'reference'):
             text = "%s [%i]" % (text, self.reference.number)
         return text
 
+    def layout(self, text, **kw):
+        index = kw.get('index')
+        cached_text = index.cached_text(self, **kw) if index is not None else None
+        if cached_text is not None:
+            # Reuse the text rendered by FindReferences (adding it as a
+            # string gives the same words as the nested text would).
+            text.append(cached_text)
+        else:
+            yield self.text_nodes(**kw)
+        if hasattr(self, 'reference'):
+            text.append(" [%i]" % self.reference.number)
+
+    def text_nodes(self, **kw):
+        """
+        Get the inline nodes that make up the text of the hyper link.
+        """
+        images = find_nodes(self, Image, kw.get('index'))
+        if len(self.contents) == 1 and len(images) == 1:
+            # If the hyper link contains a single child node which is
+            # (or contains) an image, we add a reference for the hyper
+            # link but not the image.
+            return [Text(text="Image: " + images[0].alt)]
+        return self.contents
+
 @html_element('code', 'tt')
 class CodeFragment(InlineNode):
 
@@ -1090,7 +2898,7 @@ class CodeFragment(InlineNode):
         # doesn't work in headings. To still make the transition between
         # regular text and code fragments visible to the user, we'll improvise
         # with single or double quotes.
-        if re.match('^[` \t\r\n]+$', self.text) and not any(isinstance(n, Heading) for n in self.parents):
+        if re.match('^[` \t\r\n]+$', self.text) and not self.in_heading(**kw):
             return self.text
         elif self.text.find("'") >= 0:
             return '"%s"' % self.text
@@ -1109,7 +2917,12 @@ class Emphasis(InlineNode, SequenceNode):
         return "Emphasis(contents=%r)" % self.contents
 
     def render(self, **kw):
-        return "_%s_" % join_inline(self.contents, **kw)
+        return "_%s_" % join_contents(self, self.contents, **kw)
+
+    def layout(self, text, **kw):
+        text.append("_")
+        yield self.contents
+        text.append("_")
 
 @html_element('b', 'strong')
 class Strong(InlineNode, SequenceNode):
@@ -1125,7 +2938,12 @@ class Strong(InlineNode, SequenceNode):
     def render(self, **kw):
         # We use **double** asterisks because a word enclosed in *single*
         # asterisks already has a meaning: It's a help tag definition.
-        return "**%s**" % join_inline(self.contents, **kw)
+        return "**%s**" % join_contents(self, self.contents, **kw)
+
+    def layout(self, text, **kw):
+        text.append("**")
+        yield self.contents
+        text.append("**")
 
 class Text(InlineNode):
 
@@ -1141,9 +2959,15 @@ class Text(InlineNode):
         return "Text(text=%r)" % self.text
 
     def __nonzero__(self):
-        if isinstance(self.parent, (BlockLevelSequence, ListItem)):
+        return self.is_significant(self.parent)
+
+    def is_significant(self, parent):
+        """
+        Check whether the text is significant inside the given parent node.
+        """
+        if isinstance(parent, (BlockLevelSequence, ListItem)):
             # Block level whitespace is not significant.
-            return self.text and not self.text.isspace()
+            return bool(self.text) and not self.text.isspace()
         else:
             # Inline whitespace is significant.
             return True
@@ -1151,6 +2975,769 @@ class Text(InlineNode):
     def render(self, **kw):
         return self.text
 
+    def layout(self, text, **kw):
+        text.append(self.text)
+
+# Passes over the simplified parse tree.
+
+class TreePass(object):
+
+    """
+    Base class for the passes that prepare the simplified parse tree for
+    rendering (see ``run_passes()``). A pass declares the types of the nodes
+    it visits (``node_types``), whether it visits them in document order or
+    in reverse document order (``reverse``, which means the descendants of a
+    node are visited before the node itself) and the names of the passes
+    that have to be finished before it starts (``depends``).
+
+    ``visit()`` is called for each node of the given types and ``finish()``
+    is called when the traversal is done. Passes in the same traversal visit
+    the same nodes, so ``visit()`` doesn't change the tree outside of the
+    node it visits; other changes are made in ``finish()``, which invalidates
+    the index when the structure of the tree changes.
+    """
+
+    name = None
+    node_types = ()
+    reverse = False
+    depends = ()
+
+    def __init__(self, index):
+        self.index = index
+
+    def visit(self, node):
+        pass
+
+    def finish(self):
+        pass
+
+class ShiftHeadings(TreePass):
+
+    """
+    Shift headings in such a way that top level headings have level 1.
+    """
+
+    name = 'shift_headings'
+    node_types = (Heading,)
+
+    def __init__(self, index):
+        TreePass.__init__(self, index)
+        self.headings = []
+
+    def visit(self, node):
+        self.headings.append(node)
+
+    def finish(self):
+        # Find the largest headings (lowest level).
+        min_level = None
+        logger.debug("Finding largest headings ..")
+        for node in self.headings:
+            if min_level is None:
+                min_level = node.level
+            elif node.level < min_level:
+                min_level = node.level
+        if min_level is None:
+            logger.debug("HTML document doesn't contain any headings?")
+            return
+        else:
+            logger.debug("Largest headings have level %i.", min_level)
+        # Shift the headings if necessary.
+        if min_level > 1:
+            to_subtract = min_level - 1
+            logger.debug("Shifting headings by %i levels.", to_subtract)
+            for node in self.headings:
+                node.level -= to_subtract
+
+class FindReferences(TreePass):
+
+    """
+    Give each hyper link (and image) a unique number so that it can be
+    referenced inside the Vim help file and append a section to the tree
+    which lists an overview of all references to hyper links extracted from
+    the HTML document.
+    """
+
+    name = 'find_references'
+    node_types = (HyperLink, Image)
+
+    def __init__(self, index, url):
+        TreePass.__init__(self, index)
+        self.url = url
+        # Mapping of hyper link targets to "Reference" objects.
+        self.by_target = {}
+        # Ordered list of "Reference" objects.
+        self.by_reference = []
+
+    def visit(self, node):
+        url = self.url
+        if isinstance(node, Image):
+            target = node.src
+        else:
+            target = node.target
+        if not target:
+            return
+        if target == 'http://www.vim.org/':
+            # Don't add a reference to the Vim homepage in Vim help files.
+            return
+        if target.startswith('http://vimdoc.sourceforge.net/htmldoc/'):
+            # Don't add a reference to the online Vim documentation.
+            return
+        # Try to convert relative URLs into absolute URLs.
+        if url and not re.match(r'^\w+:', target):
+            target = urlparse.urljoin(url, target)
+        # Now try to convert absolute URLs into relative URLs... This does
+        # actually make sense, but it sure sounds stupid :-p. All it really
+        # does is normalize URLs to a common format.
+        relative_target = target
+        if url:
+            relative_target = os.path.relpath(target, url)
+        if relative_target.startswith('#'):
+            # Skip links to page anchors on the same page.
+            return
+        # Exclude literal URLs from list of references.
+        if target.replace('mailto:', '') == node.render(indent=0, in_heading=False, index=self.index):
+            return
+        # Make sure we don't duplicate references.
+        if target in self.by_target:
+            r = self.by_target[target]
+        else:
+            number = len(self.by_reference) + 1
+            if tracing.enabled:
+                tracer.debug("Extracting reference #%i to %s ..", number, target)
+            r = Reference(number=number, target=target)
+            self.by_reference.append(r)
+            self.by_target[target] = r
+        node.reference = r
+        # The text of the hyper link itself doesn't change.
+        self.index.forget(self.index.parent(node))
+
+    def finish(self):
+        logger.debug("Found %i references.", len(self.by_reference))
+        if self.by_reference:
+            logger.debug("Generating 'References' section ..")
+            self.index.root.contents.append(Heading(level=1, contents=[Text(text="References")]))
+            self.index.root.contents.extend(self.by_reference)
+            self.index.invalidate()
+
+class AddIntroduction(TreePass):
+
+    """
+    Add an "Introduction" heading to separate the table of contents from the
+    start of the document text. The heading is added after the headings
+    were shifted (so that it isn't shifted itself).
+    """
+
+    name = 'add_introduction'
+    depends = ('shift_headings',)
+
+    def finish(self):
+        self.index.root.contents.insert(0, Heading(level=1, contents=[Text(text="Introduction")]))
+        self.index.invalidate()
+
+class TagHeadings(TreePass):
+
+    """
+    Generate Vim help file tags for headings. The mapping of tags to headings
+    is available as ``tags`` (the dictionary is filled while the headings are
+    visited, so passes that depend on this pass can be given the dictionary
+    before it runs). The headings added by the other passes are tagged too.
+    """
+
+    name = 'tag_headings'
+    node_types = (Heading,)
+    depends = ('find_references', 'add_introduction')
+
+    def __init__(self, index, filename):
+        TreePass.__init__(self, index)
+        self.tags = {}
+        # Use base name of filename of help file as prefix (scope) for tags.
+        prefix = re.sub(r'\.txt$', '', filename)
+        logger.debug("Vim help file name without file extension: %r", prefix)
+        # If the base name ends in a version number, we'll strip it.
+        self.prefix = re.sub(r'-\d+(\.\d+)*$', '', prefix)
+        logger.debug("Tagging headings using prefix %r ..", self.prefix)
+
+    def visit(self, node):
+        if tracing.enabled:
+            tracer.debug("Selecting tag for heading: %s", node)
+        tag = node.tag_heading(self.tags, self.prefix, self.index)
+        if tag:
+            if tracing.enabled:
+                tracer.debug("Found suitable tag: %s", tag)
+            self.tags[tag] = node
+
+class MarkTags(TreePass):
+
+    """
+    Mark references to tags defined in the document by replacing code
+    fragments whose text matches a tag with ``TagReference`` nodes. When a
+    ``VimTagsIndex`` is given as ``vim_tags`` code fragments that match a tag
+    in Vim's documentation are also replaced, as long as they look like a
+    reference (see ``looks_like_vim_tag()``).
+    """
+
+    name = 'mark_tags'
+    node_types = (CodeFragment,)
+    depends = ('tag_headings',)
+
+    def __init__(self, index, tags, vim_tags=None):
+        TreePass.__init__(self, index)
+        self.tags = tags
+        self.vim_tags = vim_tags
+        # Map sequence nodes to the code fragments that should be replaced.
+        self.replacements = collections.OrderedDict()
+
+    def visit(self, node):
+        vim_tags = self.vim_tags
+        if node.text in self.tags or (vim_tags is not None and looks_like_vim_tag(node.text) and node.text in vim_tags):
+            reference = TagReference(node.text, [Text(text=node.text)], parent=node.parent)
+            self.replacements.setdefault(self.index.parent(node), {})[node] = reference
+
+    def finish(self):
+        if debugging.enabled:
+            logger.debug("Marking %i references to tags ..", sum(map(len, self.replacements.values())))
+        # Replace the code fragments in place, only touching the sequences
+        # that actually contain references.
+        for parent, mapping in self.replacements.iteritems():
+            # The contents of a sequence can be another sequence (which the
+            # index doesn't see because iterating over it yields its contents).
+            contents = parent.contents
+            while isinstance(contents, SequenceNode):
+                contents = contents.contents
+            for i, child in enumerate(contents):
+                if child in mapping:
+                    contents[i] = mapping[child]
+            self.index.forget(parent)
+        if self.replacements:
+            self.index.invalidate()
+
+class TableOfContents(TreePass):
+
+    """
+    Generate a table of contents for the Vim help file based on the headings
+    defined in the Markdown or HTML document provided by the user.
+
+    The entries share the contents of the headings, so the references to tags
+    marked by ``MarkTags`` are included in the table of contents without
+    having to mark them again (which is why both passes can share a
+    traversal).
+    """
+
+    name = 'table_of_contents'
+    node_types = (Heading,)
+    depends = ('shift_headings', 'tag_headings')
+
+    def __init__(self, index):
+        TreePass.__init__(self, index)
+        self.entries = []
+        self.counters = []
+
+    def visit(self, heading):
+        counters = self.counters
+        if tracing.enabled:
+            tracer.debug("Stack of counters before reset: %s", counters)
+        # Forget no longer relevant counters.
+        del counters[heading.level:]
+        if tracing.enabled:
+            tracer.debug("Stack of counters after reset: %s", counters)
+        # Make the stack of counters big enough.
+        while len(counters) < heading.level:
+            counters.append(1)
+        if tracing.enabled:
+            tracer.debug("Stack of counters after padding: %s", counters)
+        self.entries.append(TableOfContentsEntry(
+            indent=heading.level,
+            number=counters[heading.level - 1],
+            heading=heading,
+            tag=getattr(heading, 'tag', None)))
+        counters[heading.level - 1] += 1
+
+    def finish(self):
+        if tracing.enabled:
+            for i, entry in enumerate(self.entries, start=1):
+                tracer.debug("Table of contents entry %i: %s", i, entry)
+        self.index.root.contents.insert(0, Heading(level=1, contents=[Text(text="Contents")]))
+        self.index.root.contents.insert(1, BlockLevelSequence(contents=self.entries))
+        self.index.invalidate()
+
+class PruneEmptyBlocks(TreePass):
+
+    """
+    Prune empty block level nodes from the tree and forget the cached text of
+    nodes that lost children. The sequences are visited in reverse document
+    order, so the children of a sequence have been pruned by the time the
+    sequence itself is visited.
+
+    Whether a sequence is empty is computed once, from its remaining
+    children, and cached on the node (see ``SequenceNode.__nonzero__()``),
+    so checking the children of a sequence doesn't search their subtrees
+    again. Pruning only removes empty nodes, so the cached values stay
+    valid while the tree is rendered. Text nodes are checked against the
+    sequence being pruned (see ``Text.is_significant()``) so that pruning
+    doesn't need the links from child nodes to parent nodes.
+    """
+
+    name = 'prune'
+    node_types = (SequenceNode,)
+    reverse = True
+    depends = ('mark_tags', 'table_of_contents')
+
+    def __init__(self, index):
+        TreePass.__init__(self, index)
+        # The sequences with a descendant that lost children.
+        self.changed = set()
+
+    def visit(self, node):
+        changed = node in self.changed
+        filtered_children = []
+        for child in node:
+            if child.is_significant(node) if isinstance(child, Text) else child:
+                filtered_children.append(child)
+            else:
+                changed = True
+        node.contents = filtered_children
+        if has_default_emptiness(node):
+            node.empty = not filtered_children
+        if changed:
+            # The ancestors are changed as well.
+            self.changed.add(self.index.parent(node))
+            self.index.forget(node, ancestors=False)
+
+    def finish(self):
+        self.index.invalidate()
+
+def schedule_passes(passes):
+    """
+    Group the given passes (``TreePass`` objects) into traversals of the
+    tree. The passes are ordered so that each pass comes after the passes it
+    depends on (passes that don't depend on each other keep their order),
+    dependencies on passes that aren't given are assumed to be satisfied
+    already. A pass joins the first traversal after the traversals of the
+    passes it depends on that visits nodes in the same direction. Passes that
+    don't visit any nodes can join the traversal of the passes they depend
+    on, because they're finished after them. Returns a list of lists of
+    passes. Raises ``ValueError`` when the dependencies contain a cycle.
+    """
+    names = set(p.name for p in passes)
+    ordered = []
+    finished = set()
+    pending = list(passes)
+    while pending:
+        for i, tree_pass in enumerate(pending):
+            if all(name in finished or name not in names for name in tree_pass.depends):
+                ordered.append(pending.pop(i))
+                finished.add(tree_pass.name)
+                break
+        else:
+            raise ValueError("Cyclic dependencies between passes: %s" % ", ".join(p.name for p in pending))
+    traversals = []
+    positions = {}
+    for tree_pass in ordered:
+        position = 0
+        for name in tree_pass.depends:
+            if name in positions:
+                position = max(position, positions[name] + (1 if tree_pass.node_types else 0))
+        while position < len(traversals) and tree_pass.node_types and \
+                any(p.reverse != tree_pass.reverse for p in traversals[position] if p.node_types):
+            position += 1
+        if position == len(traversals):
+            traversals.append([])
+        traversals[position].append(tree_pass)
+        positions[tree_pass.name] = position
+    return traversals
+
+def run_passes(index, passes, stats=None):
+    """
+    Run the given passes (``TreePass`` objects) over the tree of the given
+    ``NodeIndex``, fused into as few traversals as possible (see
+    ``schedule_passes()``). Each traversal queries the index once for the
+    nodes of all the types its passes visit and hands each node to the
+    passes that visit nodes of its type. When a ``ConversionStats`` object is
+    given the time spent in the ``visit()`` and ``finish()`` methods of each
+    pass is recorded as a stage named after the pass (even though passes
+    share traversals) and the time spent querying the index for the nodes of
+    the traversals is recorded as the 'traverse' stage. Returns the number of
+    traversals.
+    """
+    if stats is None:
+        stats = ConversionStats(enabled=False)
+    traversals = schedule_passes(passes)
+    for traversal in traversals:
+        logger.debug("Running pass(es): %s ..", ', '.join(p.name for p in traversal))
+        node_types = tuple(set(t for p in traversal for t in p.node_types))
+        if node_types:
+            with stats.stage('traverse'):
+                nodes = index.find(node_types)
+                if any(p.reverse for p in traversal if p.node_types):
+                    nodes.reverse()
+            # Map node types to the visit() methods of the passes.
+            visits = dict((p, stats.timed(p.name, p.visit)) for p in traversal)
+            visitors = {}
+            for node in nodes:
+                node_type = type(node)
+                if node_type not in visitors:
+                    visitors[node_type] = [visits[p] for p in traversal if issubclass(node_type, p.node_types)]
+                for visit in visitors[node_type]:
+                    visit(node)
+        for tree_pass in traversal:
+            with stats.stage(tree_pass.name):
+                tree_pass.finish()
+    return len(traversals)
+
+# Compact storage for simplified parse trees.
+
+class CompactTree(object):
+
+    """
+    Array backed storage for simplified parse trees. On very large documents
+    most nodes are ``Text`` nodes holding a bit of whitespace, yet every
+    ``Node`` object carries a full ``__dict__``. A compact tree stores the
+    structure of the tree in parallel arrays (node kind, parent, first child
+    and next sibling) and the text of all nodes in a table of unique strings.
+    The few other attributes (heading levels, hyper link targets, etc.) are
+    kept in sparse mappings (one for each attribute name).
+
+    The existing node classes are used through thin views (see ``NodeView``)
+    that read from and write to the arrays, so the passes and the render
+    methods work unchanged. The streaming parser adds the nodes to the tree
+    as soon as they're created (see ``StreamingTreeBuilder``) and the tree
+    is indexed by slot (see ``CompactNodeIndex``), so only the views that
+    are in use exist as objects.
+    """
+
+    def __init__(self):
+        self.kinds = array.array('B')
+        self.parents = array.array('i')
+        self.first_children = array.array('i')
+        self.next_siblings = array.array('i')
+        self.texts = array.array('i')
+        self.strings = []
+        self.string_ids = {}
+        self.types = []
+        self.type_ids = {}
+        self.attributes = {}
+
+    @classmethod
+    def pack(cls, root):
+        """
+        Copy a simplified parse tree into a new compact tree. Returns the view
+        of the root node.
+        """
+        tree = cls()
+        slot = tree.add(root)
+        logger.debug("Packed %i nodes (%i unique strings) into compact tree.", len(tree.kinds), len(tree.strings))
+        return tree.view(slot)
+
+    def add(self, node):
+        """
+        Add a node (and its descendants) to the compact tree, returns the slot
+        of the node. Views of nodes in this tree are returned as is. The
+        descendants are added using an explicit stack (instead of recursion)
+        so that deeply nested trees can be packed.
+        """
+        if isinstance(node, NodeView) and node.tree is self:
+            return node.slot
+        root = self.add_node(node)
+        pending = [(node, root)] if isinstance(node, SequenceNode) else []
+        while pending:
+            node, slot = pending.pop()
+            previous = -1
+            for child in node:
+                if isinstance(child, NodeView) and child.tree is self:
+                    child_slot = child.slot
+                else:
+                    child_slot = self.add_node(child)
+                    if isinstance(child, SequenceNode):
+                        pending.append((child, child_slot))
+                if previous < 0:
+                    self.first_children[slot] = child_slot
+                else:
+                    self.next_siblings[previous] = child_slot
+                previous = child_slot
+            if previous >= 0:
+                self.next_siblings[previous] = -1
+        return root
+
+    def add_node(self, node):
+        """
+        Add a single node to the compact tree (without its descendants),
+        returns the slot of the node.
+        """
+        node_type = node.__class__
+        if node_type not in self.type_ids:
+            self.type_ids[node_type] = len(self.types)
+            self.types.append(node_type)
+        slot = len(self.kinds)
+        self.kinds.append(self.type_ids[node_type])
+        self.parents.append(-1)
+        self.first_children.append(-1)
+        self.next_siblings.append(-1)
+        self.texts.append(-1)
+        for name, value in vars(node).iteritems():
+            if name == 'text':
+                self.texts[slot] = self.intern(value)
+            elif name == 'parent':
+                if isinstance(value, NodeView) and value.tree is self:
+                    self.parents[slot] = value.slot
+            elif name != 'contents':
+                self.set_attribute(slot, name, value)
+        return slot
+
+    def get_attribute(self, slot, name):
+        """
+        Get an attribute of the node in the given slot. Raises ``KeyError``
+        when the node doesn't have the attribute.
+        """
+        return self.attributes[name][slot]
+
+    def set_attribute(self, slot, name, value):
+        """
+        Set an attribute of the node in the given slot. The attributes are
+        stored by name (a mapping of slots to values for each name) because
+        there are few different names and most nodes have no attributes.
+        """
+        if name not in self.attributes:
+            self.attributes[name] = {}
+        self.attributes[name][slot] = value
+
+    def intern(self, string):
+        """
+        Get the index of a string in the table of unique strings.
+        """
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def view(self, slot):
+        """
+        Get a view of the node in the given slot (None for slot -1).
+        """
+        if slot < 0:
+            return None
+        return NodeView.create(self, slot)
+
+    def children(self, slot):
+        """
+        Get the slots of the child nodes of the node in the given slot.
+        """
+        slots = []
+        child = self.first_children[slot]
+        while child >= 0:
+            slots.append(child)
+            child = self.next_siblings[child]
+        return slots
+
+    def set_contents(self, slot, nodes):
+        """
+        Replace the child nodes of the node in the given slot. Nodes that
+        aren't part of the tree yet are added to it.
+        """
+        previous = -1
+        for node in nodes:
+            child = self.add(node)
+            if previous < 0:
+                self.first_children[slot] = child
+            else:
+                self.next_siblings[previous] = child
+            previous = child
+        if previous < 0:
+            self.first_children[slot] = -1
+        else:
+            self.next_siblings[previous] = -1
+
+class NodeView(object):
+
+    """
+    Thin view of a node stored in a ``CompactTree``. View classes are created
+    on demand as subclasses of both this class and the original node class
+    (so ``isinstance()`` checks and all methods keep working) while the
+    attributes are read from and written to the arrays of the compact tree.
+    Views are equal when they refer to the same slot of the same tree.
+    """
+
+    __slots__ = ()
+
+    # Mapping of node types to their view classes.
+    view_classes = {}
+
+    @classmethod
+    def create(cls, tree, slot):
+        node_type = tree.types[tree.kinds[slot]]
+        if node_type not in cls.view_classes:
+            cls.view_classes[node_type] = type(node_type.__name__, (NodeView, node_type), dict(__slots__=('tree', 'slot')))
+        view = object.__new__(cls.view_classes[node_type])
+        object.__setattr__(view, 'tree', tree)
+        object.__setattr__(view, 'slot', slot)
+        return view
+
+    def __getattr__(self, name):
+        if name in ('tree', 'slot'):
+            # Don't recurse on uninitialized views.
+            raise AttributeError(name)
+        tree, slot = self.tree, self.slot
+        if name == 'contents' and isinstance(self, SequenceNode):
+            return ChildList(self, (tree.view(s) for s in tree.children(slot)))
+        elif name == 'parent':
+            return tree.view(tree.parents[slot])
+        elif name == 'text' and tree.texts[slot] >= 0:
+            return tree.strings[tree.texts[slot]]
+        try:
+            return tree.get_attribute(slot, name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        tree, slot = self.tree, self.slot
+        if name == 'contents':
+            tree.set_contents(slot, value)
+        elif name == 'parent':
+            tree.parents[slot] = value.slot if isinstance(value, NodeView) and value.tree is tree else -1
+        elif name == 'text':
+            tree.texts[slot] = tree.intern(value)
+        else:
+            tree.set_attribute(slot, name, value)
+
+    def __iter__(self):
+        """
+        Iterate over the child nodes without materializing a ``ChildList``.
+        """
+        if not isinstance(self, SequenceNode):
+            raise TypeError("%s object is not iterable" % self.__class__.__name__)
+        tree = self.tree
+        child = tree.first_children[self.slot]
+        while child >= 0:
+            yield tree.view(child)
+            child = tree.next_siblings[child]
+
+    def __eq__(self, other):
+        return isinstance(other, NodeView) and self.tree is other.tree and self.slot == other.slot
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.slot))
+
+class CompactNodeIndex(NodeIndex):
+
+    """
+    Index of the nodes in a simplified parse tree that's stored in a
+    ``CompactTree``. Instead of a view for every node the index stores the
+    slots of the nodes in arrays (and the positions of the slots in an array
+    indexed by slot instead of a dictionary keyed by node). The tree is
+    walked using the arrays of the compact tree, views are only created for
+    the nodes returned by queries.
+    """
+
+    def __init__(self, root):
+        self.tree = root.tree
+        NodeIndex.__init__(self, root)
+
+    def update(self):
+        """
+        Rebuild the index if the tree has changed since it was last built.
+        """
+        if self.stale:
+            logger.debug("Building index of compact parse tree ..")
+            self.nodes = array.array('i')
+            self.parents = array.array('i')
+            self.sizes = array.array('i')
+            self.positions = array.array('i', [-1]) * len(self.tree.kinds)
+            self.scan(self.root)
+            self.stale = False
+            logger.debug("Indexed %i nodes of %i types.", len(self.nodes), len(self.by_type))
+
+    def scan(self, root):
+        """
+        Add a node and its descendants to the index. The tree is walked by
+        following the first child and next sibling arrays of the compact tree
+        (without recursion and without creating views).
+        """
+        tree = self.tree
+        kinds = tree.kinds
+        first_children = tree.first_children
+        next_siblings = tree.next_siblings
+        is_sequence = [issubclass(t, SequenceNode) for t in tree.types]
+        by_kind = [array.array('i') for t in tree.types]
+        # The positions of the ancestors of the current node.
+        path = []
+        slot = root.slot
+        while True:
+            position = len(self.nodes)
+            self.nodes.append(slot)
+            self.parents.append(path[-1] if path else -1)
+            self.sizes.append(0)
+            self.positions[slot] = position
+            by_kind[kinds[slot]].append(position)
+            if is_sequence[kinds[slot]] and first_children[slot] >= 0:
+                path.append(position)
+                slot = first_children[slot]
+                continue
+            # Move on to the next sibling of the node or of its closest
+            # ancestor that has one (the number of descendants of the
+            # ancestors that are left behind is known at this point).
+            while path and next_siblings[slot] < 0:
+                ancestor = path.pop()
+                self.sizes[ancestor] = len(self.nodes) - ancestor - 1
+                slot = self.nodes[ancestor]
+            if not path:
+                break
+            slot = next_siblings[slot]
+        self.by_type = dict((t, positions) for t, positions in zip(tree.types, by_kind) if positions)
+
+    def position(self, node):
+        if isinstance(node, NodeView) and node.tree is self.tree and node.slot < len(self.positions):
+            position = self.positions[node.slot]
+            if position >= 0:
+                return position
+
+    def node(self, position):
+        return self.tree.view(self.nodes[position])
+
+    def key(self, node):
+        if isinstance(node, NodeView) and node.tree is self.tree:
+            return node.slot
+        return node
+
+class ChildList(list):
+
+    """
+    List of child node views that writes changes back to the compact tree.
+    """
+
+    def __init__(self, owner, nodes):
+        list.__init__(self, nodes)
+        self.owner = owner
+
+    def update(self):
+        self.owner.contents = self
+
+    def append(self, node):
+        list.append(self, node)
+        self.update()
+
+    def extend(self, nodes):
+        list.extend(self, nodes)
+        self.update()
+
+    def insert(self, i, node):
+        list.insert(self, i, node)
+        self.update()
+
+    def __setitem__(self, i, node):
+        list.__setitem__(self, i, node)
+        self.update()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.update()
+
+    def pop(self, i=-1):
+        node = list.pop(self, i)
+        self.update()
+        return node
+
 def is_block_level(contents):
     """
     Return True if any of the nodes in the given sequence is a block level
@@ -1158,6 +3745,26 @@ def is_block_level(contents):
     """
     return any(isinstance(n, BlockLevelNode) for n in contents)
 
+def has_default_emptiness(node):
+    """
+    Return True if the given node is a sequence whose emptiness is defined by
+    its children (see ``SequenceNode.__nonzero__()``), False otherwise.
+    """
+    return isinstance(node, SequenceNode) and type(node).__nonzero__ == SequenceNode.__nonzero__
+
+def is_whitespace(node):
+    """
+    Return True if the given node (and its descendants) contains nothing but
+    whitespace, False otherwise.
+    """
+    for n in walk_tree(node):
+        if isinstance(n, Text):
+            if n.text.strip():
+                return False
+        elif not isinstance(n, SequenceNode):
+            return False
+    return True
+
 def join_smart(nodes, **kw):
     """
     Join a sequence of block level and/or inline nodes into a single string.
@@ -1185,19 +3792,286 @@ def join_blocks(nodes, **kw):
 
 def join_inline(nodes, **kw):
     """
-    Join a sequence of inline nodes into a single string.
+    Join a sequence of inline nodes into a single string. The inline nodes
+    add their text to a single stream of word and glue tokens (see
+    ``InlineText``) which is broken into lines only once.
     """
     # Render the indentation at the current level.
     prefix = ' ' * kw['indent']
     # Reset the indentation for nested inline nodes.
     kw['indent'] = 0
     # Render the inline nodes.
-    logger.debug("Inline nodes: %s", nodes)
-    rendered_nodes = [n.render(**kw) for n in nodes]
-    return "\n".join(textwrap.wrap(compact("".join(rendered_nodes)),
-                                   initial_indent=prefix,
-                                   subsequent_indent=prefix,
-                                   width=TEXT_WIDTH - len(prefix)))
+    if tracing.enabled:
+        tracer.debug("Inline nodes: %s", nodes)
+    text = InlineText()
+    text.layout(nodes, **kw)
+    text.strip_glue()
+    return "\n".join(line_breaker.wrap(text.words(), TEXT_WIDTH - len(prefix), prefix))
+
+def join_contents(node, contents, **kw):
+    """
+    Join the inline contents of a node into a single string using
+    ``join_inline()``. When the caller passes the ``NodeIndex`` as ``index``
+    the text is cached by the index, so the contents of a node are rendered
+    only once for each indentation and heading context.
+    """
+    index = kw.get('index')
+    if index is None:
+        return join_inline(contents, **kw)
+    text = index.cached_text(node, **kw)
+    if text is None:
+        text = join_inline(contents, **kw)
+        index.cache_text(node, text, **kw)
+    return text
+
+class InlineText(object):
+
+    """
+    Stream of word and glue tokens produced by the ``layout()`` methods of
+    inline nodes. Words are added in pieces (strings) and whitespace becomes
+    glue (``None``) between the pieces. Glue never occurs twice in a row and
+    never at the start of the text, so the words are the same as those of
+    the concatenated text after ``compact()``.
+
+    Nested inline nodes (emphasis, hyper links, etc.) used to wrap their own
+    text before the enclosing block wrapped everything again. That made a
+    difference only where the nested text was broken inside a word (after a
+    hyphen or in a word longer than a line) because those line breaks turned
+    into spaces. To keep the output the same ``end_nested()`` still does
+    this, but only for nested text that's longer than a line and contains
+    hyphens or long words (tracked with counters while the tokens are added).
+    """
+
+    def __init__(self):
+        self.tokens = []
+        # Index of the first token of the innermost nested text.
+        self.start = 0
+        # Counters used to decide whether nested text needs wrapping.
+        self.length = 0
+        self.hyphens = 0
+        self.long_words = 0
+        self.word_length = 0
+
+    def append(self, text):
+        """
+        Add a string to the stream (whitespace in the string becomes glue).
+        """
+        if not isinstance(text, basestring):
+            raise TypeError("expected string or Unicode, %s found" % type(text).__name__)
+        if text and text[0].isspace():
+            self.glue()
+        words = text.split()
+        for i, word in enumerate(words):
+            if i > 0:
+                self.glue()
+            self.tokens.append(word)
+            self.length += len(word)
+            self.word_length += len(word)
+            if '-' in word:
+                self.hyphens += 1
+        if words and text[-1].isspace():
+            self.glue()
+
+    def glue(self):
+        """
+        Add glue to the stream (whitespace between two words).
+        """
+        if len(self.tokens) > self.start and self.tokens[-1] is not None:
+            self.tokens.append(None)
+            self.length += 1
+            if self.word_length > TEXT_WIDTH:
+                self.long_words += 1
+            self.word_length = 0
+
+    def strip_glue(self):
+        """
+        Remove glue from the end of the (nested) text.
+        """
+        if len(self.tokens) > self.start and self.tokens[-1] is None:
+            self.tokens.pop()
+            self.length -= 1
+            # The last word can be continued.
+            self.word_length = 0
+            for i in xrange(len(self.tokens) - 1, -1, -1):
+                if self.tokens[i] is None:
+                    break
+                self.word_length += len(self.tokens[i])
+
+    def layout(self, nodes, **kw):
+        """
+        Add the text of the given inline nodes. The ``layout()`` methods of
+        inline nodes that contain other inline nodes are generators which
+        yield the nodes whose text should be nested (see ``begin_nested()``
+        and ``end_nested()``). They are driven using an explicit stack instead
+        of recursion, so deeply nested inline nodes don't exceed Python's
+        recursion limit.
+        """
+        # Each frame holds an iterator over the nodes to add, the generator
+        # to resume when they have been added and the state of the nesting.
+        frames = [(iter(nodes), None, None)]
+        while frames:
+            children, generator, state = frames[-1]
+            for node in children:
+                nested = node.layout(self, **kw)
+                if nested is not None and self.resume(nested, frames):
+                    # Add the nested nodes first.
+                    break
+            else:
+                frames.pop()
+                if generator is not None:
+                    self.end_nested(state)
+                    self.resume(generator, frames)
+
+    def resume(self, generator, frames):
+        """
+        Run the ``layout()`` generator of an inline node until it yields the
+        nodes whose text should be nested (a new frame is pushed for them,
+        returns True) or until it's finished (returns False).
+        """
+        for nodes in generator:
+            frames.append((iter(nodes), generator, self.begin_nested()))
+            return True
+        return False
+
+    def begin_nested(self):
+        """
+        Start nested text, returns the state needed by ``end_nested()``.
+        """
+        state = (self.start, len(self.tokens), self.length, self.hyphens, self.long_words)
+        self.start = len(self.tokens)
+        return state
+
+    def end_nested(self, state):
+        """
+        Finish nested text: Trim whitespace and wrap the text when needed.
+        """
+        outer_start, start, length, hyphens, long_words = state
+        self.strip_glue()
+        # Nested text that fits on a line is never broken into lines (so
+        # there's nothing to emulate).
+        if self.length - length > TEXT_WIDTH:
+            # textwrap.wrap() breaks lines after the hyphens in words, e.g.
+            # "well-" and "known", which became "well- known".
+            if self.hyphens > hyphens:
+                self.wrap_nested(start)
+            # textwrap.wrap() breaks words that don't fit on a line, the
+            # pieces became separate words. The last word is still being
+            # measured (long_words counts the words that have been followed
+            # by glue).
+            elif self.long_words > long_words or self.word_length > TEXT_WIDTH:
+                self.wrap_nested(start)
+        self.start = outer_start
+
+    def wrap_nested(self, start):
+        """
+        Insert glue where wrapping the nested text (starting at the given
+        token index) breaks lines inside words.
+        """
+        words = self.words(start)
+        wrapped = " ".join(line_breaker.wrap(words, TEXT_WIDTH)).split()
+        if len(wrapped) > len(words):
+            if tracing.enabled:
+                tracer.debug("Wrapping nested text broke words, adding glue ..")
+            tokens = []
+            for word in wrapped:
+                if tokens:
+                    tokens.append(None)
+                tokens.append(word)
+            self.tokens[start:] = tokens
+            self.length += len(wrapped) - len(words)
+
+    def words(self, start=0):
+        """
+        Get the words in the stream (starting at the given token index).
+        """
+        words = []
+        pieces = []
+        for i in xrange(start, len(self.tokens)):
+            token = self.tokens[i]
+            if token is not None:
+                pieces.append(token)
+            elif pieces:
+                words.append("".join(pieces))
+                pieces = []
+        if pieces:
+            words.append("".join(pieces))
+        return words
+
+class LineBreaker(object):
+
+    """
+    Breaks a sequence of words into lines exactly like ``textwrap.wrap()``
+    breaks the words joined by single spaces. The words are split into chunks
+    (after hyphens) by the regular expressions of ``textwrap.TextWrapper``;
+    the chunks and their widths are cached because most words occur many
+    times in a document.
+    """
+
+    def __init__(self, cache_size=100000):
+        self.wrapper = textwrap.TextWrapper()
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def split(self, word):
+        """
+        Get the chunks of a word as a list of (chunk, width) tuples.
+        """
+        chunks = self.cache.get(word)
+        if chunks is None:
+            if isinstance(word, unicode):
+                pattern = self.wrapper.wordsep_re_uni
+            else:
+                pattern = self.wrapper.wordsep_re
+            chunks = [(c, len(c)) for c in pattern.split(word) if c]
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[word] = chunks
+        return chunks
+
+    def wrap(self, words, width, indent=''):
+        """
+        Break words into lines of at most the given width (which includes the
+        indentation added to every line).
+        """
+        if width <= 0:
+            raise ValueError("invalid width %r (must be > 0)" % width)
+        # Reversed list of (chunk, width) tuples, like in
+        # textwrap.TextWrapper._wrap_chunks() (which this is a port of).
+        chunks = []
+        for word in words:
+            if chunks:
+                chunks.append((" ", 1))
+            chunks.extend(self.split(word))
+        chunks.reverse()
+        width -= len(indent)
+        lines = []
+        while chunks:
+            line = []
+            line_width = 0
+            # Drop whitespace at the start of lines (except the first).
+            if lines and chunks[-1][0].strip() == '':
+                chunks.pop()
+            while chunks:
+                chunk, chunk_width = chunks[-1]
+                if line_width + chunk_width > width:
+                    break
+                line.append(chunk)
+                line_width += chunk_width
+                chunks.pop()
+            if chunks and chunks[-1][1] > width:
+                # Break words that don't fit on a line by themselves.
+                space_left = width - line_width if width >= 1 else 1
+                chunk = chunks[-1][0]
+                line.append(chunk[:space_left])
+                chunks[-1] = (chunk[space_left:], len(chunk) - space_left)
+            # Drop whitespace at the end of lines.
+            if line and line[-1].strip() == '':
+                line.pop()
+            if line:
+                lines.append(indent + "".join(line))
+        return lines
+
+line_breaker = LineBreaker()
 
 def compact(text):
     """
@@ -1209,7 +4083,8 @@ def create_tag(text, prefix, is_code):
     """
     Convert arbitrary text to a Vim help file tag.
     """
-    logger.debug("Creating tag from text %r with prefix %r (is_code=%r)", text, prefix, is_code)
+    if tracing.enabled:
+        tracer.debug("Creating tag from text %r with prefix %r (is_code=%r)", text, prefix, is_code)
     if is_code:
         # Preserve the case of programming language identifiers.
         anchor = text
@@ -1244,19 +4119,9 @@ def create_tag(text, prefix, is_code):
         anchor = re.sub('[^A-Za-z0-9_().]+', '-', anchor)
     # Trim leading/trailing sanitized characters.
     anchor = anchor.strip('-')
-    logger.debug("Resulting tag: %r", anchor)
+    if tracing.enabled:
+        tracer.debug("Resulting tag: %r", anchor)
     return anchor
 
-def flatten(l):
-    """
-    From http://stackoverflow.com/a/2158532/788200.
-    """
-    for el in l:
-        if isinstance(el, collections.Iterable) and not isinstance(el, basestring):
-            for sub in flatten(el):
-                yield sub
-        else:
-            yield el
-
 if __name__ == '__main__':
     main()
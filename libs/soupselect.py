@@ -10,109 +10,300 @@ select(soup, 'div')
 select(soup, 'div#main ul a')
 - returns a list of links inside a ul inside div#main
 
+select(soup, 'div#main > ul, div.footer')
+- returns a list of the ul elements that are children of div#main and
+  the div elements with class footer
+
+Selectors are compiled once (see compile_selector()) and cached. Matching
+elements are found in a single traversal of the document and returned in
+document order, without duplicates.
+
 """
 
 import re
 
-tag_re = re.compile('^[a-z0-9]+$')
+tag_re = re.compile('^([a-z0-9]+|\*)')
 
-attribselect_re = re.compile(
-    r'^(?P<tag>\w+)?\[(?P<attribute>\w+)(?P<operator>[=~\|\^\$\*]?)' + 
-    r'=?"?(?P<value>[^\]"]*)"?\]$'
+# The parts of a compound selector following the tag name:
+#
+#   #id, .class or [attribute], [attribute=value], [attribute~=value], etc.
+#
+# /\[(\w+)([=~\|\^\$\*]?)=?"?([^\]"]*)"?\]/
+#    \---/\-------------/    \-------/
+#      |         |               |
+#      |         |           The value
+#      |    ~,|,^,$,* or =
+#   Attribute
+simple_selector_re = re.compile(
+    r'(?P<type>[#.])(?P<name>[\w-]+)|' +
+    r'\[(?P<attribute>\w+)(?P<operator>[=~\|\^\$\*]?)=?"?(?P<value>[^\]"]*)"?\]'
 )
 
-# /^(\w+)\[(\w+)([=~\|\^\$\*]?)=?"?([^\]"]*)"?\]$/
-#   \---/  \---/\-------------/    \-------/
-#     |      |         |               |
-#     |      |         |           The value
-#     |      |    ~,|,^,$,* or =
-#     |   Attribute 
-#    Tag
+# Whitespace and '>' (outside of attribute selectors) separate the compound
+# selectors of a complex selector.
+combinator_re = re.compile(r'\s*(>)\s*|\s+(?![^\[]*\])')
+
+# Cache of compiled selectors.
+compiled_selectors = {}
+
+def get_attribute(el, attribute, default=None):
+    """
+    Returns the value of an attribute of an element. The attributes of
+    BeautifulSoup tags are a list of (name, value) tuples which is searched
+    directly, because the first call to Tag.get() searches the whole subtree
+    of the tag (Tag.__getattr__() treats the missing attribute map as the
+    name of a child tag). Other elements can use a dictionary.
+    """
+    attrs = el.attrs
+    if isinstance(attrs, dict):
+        return attrs.get(attribute, default)
+    # The last occurrence of an attribute wins (like it does in Tag.get()).
+    for i in xrange(len(attrs) - 1, -1, -1):
+        if attrs[i][0] == attribute:
+            return attrs[i][1]
+    return default
 
 def attribute_checker(operator, attribute, value=''):
     """
     Takes an operator, attribute and optional value; returns a function that
     will return True for elements that match that combination.
     """
-    return {
-        '=': lambda el: el.get(attribute) == value,
+    if operator == '=':
+        return lambda el: get_attribute(el, attribute) == value
+    elif operator == '~':
         # attribute includes value as one of a set of space separated tokens
-        '~': lambda el: value in el.get(attribute, '').split(),
+        return lambda el: value in get_attribute(el, attribute, '').split()
+    elif operator == '^':
         # attribute starts with value
-        '^': lambda el: el.get(attribute, '').startswith(value),
+        return lambda el: get_attribute(el, attribute, '').startswith(value)
+    elif operator == '$':
         # attribute ends with value
-        '$': lambda el: el.get(attribute, '').endswith(value),
+        return lambda el: get_attribute(el, attribute, '').endswith(value)
+    elif operator == '*':
         # attribute contains value
-        '*': lambda el: value in el.get(attribute, ''),
+        return lambda el: value in get_attribute(el, attribute, '')
+    elif operator == '|':
         # attribute is either exactly value or starts with value-
-        '|': lambda el: el.get(attribute, '') == value \
-            or el.get(attribute, '').startswith('%s-' % value),
-    }.get(operator, lambda el: el.has_key(attribute))
+        return lambda el: get_attribute(el, attribute, '') == value \
+            or get_attribute(el, attribute, '').startswith('%s-' % value)
+    else:
+        return lambda el: get_attribute(el, attribute) is not None
+
+def id_checker(id):
+    return lambda el: get_attribute(el, 'id') == id
+
+def class_checker(klass):
+    def check(el):
+        attr = get_attribute(el, 'class')
+        return bool(attr) and klass in attr.split()
+    return check
+
+def compound_checker(token):
+    """
+    Takes a compound selector (e.g. 'div#main.wide[lang]') and returns a tuple
+    with the tag name (None for any tag), a function that will return True
+    for elements that match the other parts (None when there are none) and
+    the most specific (id, class) part that an element must have to match
+    (None when there's no such part). Returns None for invalid selectors.
+    """
+    tag = None
+    m = tag_re.match(token)
+    if m:
+        if m.group(1) != '*':
+            tag = m.group(1)
+        token = token[m.end():]
+    checkers = []
+    key = None
+    position = 0
+    while position < len(token):
+        m = simple_selector_re.match(token, position)
+        if not m:
+            return None
+        if m.group('type') == '#':
+            checkers.append(id_checker(m.group('name')))
+            if not key or key[0] != 'id':
+                key = ('id', m.group('name'))
+        elif m.group('type') == '.':
+            checkers.append(class_checker(m.group('name')))
+            if not key:
+                key = ('class', m.group('name'))
+        else:
+            checkers.append(attribute_checker(m.group('operator'),
+                                              m.group('attribute'),
+                                              m.group('value')))
+        position = m.end()
+    if not checkers:
+        return tag, None, key
+    elif len(checkers) == 1:
+        return tag, checkers[0], key
+    def check(el):
+        for checker in checkers:
+            if not checker(el):
+                return False
+        return True
+    return tag, check, key
+
+def is_element(node):
+    """
+    Returns False for None and for the root of the tree (the node without a
+    parent, which represents the document itself).
+    """
+    return node is not None and node.parent is not None
+
+class Selector(object):
+
+    """
+    A compiled selector list. Each complex selector in the list is stored as
+    a list of (tag, checker, combinator) tuples ordered from right to left
+    (see compound_checker()), where the combinator (' ' or '>') relates a
+    compound selector to the compound selector on its left (it's None for
+    the leftmost compound selector). Invalid selectors are left out.
+
+    To avoid testing every alternative against every element, the
+    alternatives are grouped by the ID, class or tag name required by their
+    rightmost compound selector; only the alternatives in the groups that
+    apply to an element (and those that can match any element) are tested.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.alternatives = []
+        self.by_id = {}
+        self.by_class = {}
+        self.by_tag = {}
+        self.universal = []
+        for part in text.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            # The compound selectors are interleaved with the captured
+            # combinators (None for whitespace).
+            tokens = combinator_re.split(part)
+            compounds = [compound_checker(c) for c in tokens[0::2]]
+            if None in compounds:
+                continue
+            combinators = [c or ' ' for c in tokens[1::2]]
+            steps = []
+            for i in xrange(len(compounds) - 1, -1, -1):
+                tag, checker, key = compounds[i]
+                steps.append((tag, checker, combinators[i - 1] if i > 0 else None))
+            self.alternatives.append(steps)
+            tag, checker, key = compounds[-1]
+            if key and key[0] == 'id':
+                self.by_id.setdefault(key[1], []).append(steps)
+            elif key:
+                self.by_class.setdefault(key[1], []).append(steps)
+            elif tag:
+                self.by_tag.setdefault(tag, []).append(steps)
+            else:
+                self.universal.append(steps)
+
+    def matches(self, element):
+        """
+        Returns True if element matches any of the alternatives. Only the
+        element and its ancestors are inspected.
+        """
+        if self.by_id:
+            alternatives = self.by_id.get(get_attribute(element, 'id'))
+            if alternatives and self.match_any(alternatives, element):
+                return True
+        if self.by_class:
+            attr = get_attribute(element, 'class')
+            if attr:
+                for klass in attr.split():
+                    alternatives = self.by_class.get(klass)
+                    if alternatives and self.match_any(alternatives, element):
+                        return True
+        if self.by_tag:
+            alternatives = self.by_tag.get(element.name)
+            if alternatives and self.match_any(alternatives, element):
+                return True
+        return bool(self.universal) and self.match_any(self.universal, element)
+
+    def match_any(self, alternatives, element):
+        for steps in alternatives:
+            if self.match_steps(steps, 0, element):
+                return True
+        return False
+
+    def match_steps(self, steps, i, element):
+        tag, checker, combinator = steps[i]
+        if tag is not None and element.name != tag:
+            return False
+        if checker is not None and not checker(element):
+            return False
+        if combinator is None:
+            return True
+        ancestor = element.parent
+        if combinator == '>':
+            return is_element(ancestor) and self.match_steps(steps, i + 1, ancestor)
+        while is_element(ancestor):
+            if self.match_steps(steps, i + 1, ancestor):
+                return True
+            ancestor = ancestor.parent
+        return False
+
+    def iselect(self, soup, nested=True):
+        """
+        Generates the descendants of soup that match the selector in
+        document order. When nested is False the descendants of matching
+        elements are skipped.
+        """
+        # Stack of iterators over the contents of the elements being visited.
+        stack = [iter(soup.contents)]
+        while stack:
+            for node in stack[-1]:
+                # Text nodes are (subclasses of) strings.
+                if isinstance(node, basestring):
+                    continue
+                if self.matches(node):
+                    yield node
+                    if not nested:
+                        continue
+                if node.contents:
+                    stack.append(iter(node.contents))
+                    break
+            else:
+                stack.pop()
 
+def compile_selector(selector):
+    """
+    Get the compiled version of a selector (list), compiling it on first use.
+    """
+    compiled = compiled_selectors.get(selector)
+    if compiled is None:
+        compiled = Selector(selector)
+        compiled_selectors[selector] = compiled
+    return compiled
 
 def select(soup, selector):
     """
-    soup should be a BeautifulSoup instance; selector is a CSS selector 
+    soup should be a BeautifulSoup instance; selector is a CSS selector
     specifying the elements you want to retrieve.
     """
-    tokens = selector.split()
-    current_context = [soup]
-    for token in tokens:
-        m = attribselect_re.match(token)
-        if m:
-            # Attribute selector
-            tag, attribute, operator, value = m.groups()
-            if not tag:
-                tag = True
-            checker = attribute_checker(operator, attribute, value)
-            found = []
-            for context in current_context:
-                found.extend([el for el in context.findAll(tag) if checker(el)])
-            current_context = found
-            continue
-        if '#' in token:
-            # ID selector
-            tag, id = token.split('#', 1)
-            if not tag:
-                tag = True
-            el = current_context[0].find(tag, {'id': id})
-            if not el:
-                return [] # No match
-            current_context = [el]
-            continue
-        if '.' in token:
-            # Class selector
-            tag, klass = token.split('.', 1)
-            if not tag:
-                tag = True
-            found = []
-            for context in current_context:
-                found.extend(
-                    context.findAll(tag,
-                        {'class': lambda attr: attr and klass in attr.split()}
-                    )
-                )
-            current_context = found
-            continue
-        if token == '*':
-            # Star selector
-            found = []
-            for context in current_context:
-                found.extend(context.findAll(True))
-            current_context = found
-            continue
-        # Here we should just have a regular tag
-        if not tag_re.match(token):
-            return []
-        found = []
-        for context in current_context:
-            found.extend(context.findAll(token))
-        current_context = found
-    return current_context
+    return list(compile_selector(selector).iselect(soup))
+
+def iselect(soup, selector):
+    """
+    Like select() but generates the matching elements one at a time, so the
+    traversal stops as soon as the caller has seen enough matches.
+    """
+    return compile_selector(selector).iselect(soup)
+
+def matches(element, selector):
+    """
+    Returns True if element matches selector. Only the element itself and its
+    ancestors are inspected, so this also works for elements of a document
+    that is still being parsed. The element needs the attributes name, parent
+    and attrs (a dictionary or a list of (name, value) tuples, like the
+    attributes of BeautifulSoup tags); the root of the tree (the element
+    without a parent) represents the document and never matches.
+    """
+    return compile_selector(selector).matches(element)
 
 def monkeypatch(BeautifulSoupClass=None):
     """
-    If you don't explicitly state the class to patch, defaults to the most 
+    If you don't explicitly state the class to patch, defaults to the most
     common import location for BeautifulSoup.
     """
     if not BeautifulSoupClass:
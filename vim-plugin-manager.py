@@ -217,6 +217,14 @@ class VimPluginManager:
             items['directory'] = directory
             self.plugins[plugin_name] = items
 
+    def plugin_flag(self, plugin_name, option):
+        """
+        Check whether a boolean option is enabled in the configuration of a
+        plug-in (options that aren't given are disabled).
+        """
+        value = self.plugins[plugin_name].get(option, 'no')
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+
     ## Management of uncommitted changes.
 
     def summarize_uncommitted_changes(self):
@@ -708,12 +716,25 @@ class VimPluginManager:
         help_path = os.path.join(help_dir, help_file)
         self.logger.info("Converting %s to %s ..", readme, help_path)
         markdown = vfs.read('README.md')
-        html = html2vimdoc.markdown_to_html(markdown, [])
-        vimdoc = html2vimdoc.html2vimdoc(html, filename=help_file)
+        cache = html2vimdoc.ConversionCache()
+        # Only render the changed sections of the help file? (this is
+        # disabled by default, see the `incremental' option of plug-ins)
+        sections = html2vimdoc.SectionCache() if self.plugin_flag(plugin_name, 'incremental') else None
+        # Update doc/tags so that we don't need to run Vim's :helptags? (this
+        # is disabled by default, see the `update-tags' option of plug-ins)
+        tags = html2vimdoc.TagsFile(os.path.join(help_dir, 'tags')) if self.plugin_flag(plugin_name, 'update-tags') else None
+        vimdoc = html2vimdoc.html2vimdoc(markdown, filename=help_file,
+                                         markdown_extensions=[],
+                                         cache=cache,
+                                         sections=sections,
+                                         tags=tags)
+        self.logger.debug("Conversion cache: %i hit(s), %i miss(es).", cache.hits, cache.misses)
         if not os.path.isdir(help_dir):
             os.mkdir(help_dir)
         with codecs.open(help_path, 'w', 'utf-8') as handle:
             handle.write("%s\n" % vimdoc)
+        if tags is not None:
+            tags.save()
         run('git', 'add', help_path, cwd=directory)
 
     def depends_on_vim_misc(self, plugin_name):